@@ -0,0 +1,233 @@
+"""
+Open plain or compressed (gzip, bz2, xz/lzma) files the same way, so the readers and writers do not need to know
+how a file is stored. The writing (and optionally the reading) can run in background threads.
+"""
+from Queue import Queue
+import bz2
+import gzip
+import os
+import re
+import sys
+import threading
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        # xz files are not supported without the backports.lzma package.
+        lzma = None
+
+
+_EXTENSIONS = {'.gz': 'gzip', '.gzip': 'gzip', '.bz2': 'bz2', '.xz': 'lzma', '.lzma': 'lzma'}
+# bz2 starts with plain ascii 'BZh', so the block size digit and the first block (or end of stream) magic are
+# matched too, not to take a text file for bz2.
+_MAGIC_BYTES = ((re.compile(r'\x1f\x8b'), 'gzip'), (re.compile(r'BZh[1-9](1AY&SY|\x17rE8P\x90)'), 'bz2'),
+                (re.compile(r'\xfd7zXZ\x00'), 'lzma'))
+
+
+def compression_of(filename, mode='r'):
+    """
+    'gzip', 'bz2', 'lzma' or None, from the extension of filename, or from its first bytes when reading a regular
+    file. Pipes (/dev/stdin, process substitution etc.) can not be read twice, so they go by the extension only.
+    """
+    compression = _EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+    if compression is not None or 'r' not in mode or not os.path.isfile(filename):
+        return compression
+
+    with open(filename, 'rb') as fin:
+        head = fin.read(10)
+
+    for magic, name in _MAGIC_BYTES:
+        if magic.match(head):
+            return name
+
+    return None
+
+
+def open_file(filename, mode='r', compression='infer', compresslevel=6, threaded=False):
+    """
+    Like open(), but the file can be compressed. compression is 'infer' (see compression_of), None, 'gzip', 'bz2'
+    or 'lzma'. compresslevel is only used for writing.
+
+    With threaded, a compressed file opened for reading is decompressed in a background thread (see
+    ThreadedLineReader). It's off by default: python 2's gzip decompresses its lines holding the GIL, so the
+    thread mostly adds the queue's cost (about 15% slower reading and splitting a gzip file). It can pay off
+    when the caller spends its time in code that releases the GIL.
+    """
+    if compression == 'infer':
+        compression = compression_of(filename, mode)
+
+    if compression is None:
+        return open(filename, mode)
+
+    binary_mode = mode[0] + 'b'
+    if compression == 'gzip':
+        fileobj = gzip.open(filename, binary_mode, compresslevel)
+    elif compression == 'bz2':
+        fileobj = bz2.BZ2File(filename, binary_mode, compresslevel=compresslevel)
+    elif compression == 'lzma':
+        if lzma is None:
+            raise ImportError('backports.lzma is needed for %s.' % filename)
+        fileobj = lzma.LZMAFile(filename, binary_mode, preset=compresslevel if mode[0] != 'r' else None)
+    else:
+        raise ValueError('Unknown compression %s.' % compression)
+
+    if threaded and mode[0] == 'r':
+        return ThreadedLineReader(fileobj)
+
+    return fileobj
+
+
+class ThreadedLineReader(object):
+    """
+    Read the lines of fileobj in a background thread. The lines go through a bounded queue in blocks of about
+    block_bytes, at most max_blocks ahead of the reader. It can be iterated, and has readline(), next() and
+    close(), and works with the with statement.
+    """
+    def __init__(self, fileobj, block_bytes=1 << 20, max_blocks=8):
+        self._fileobj = fileobj
+        self._block_bytes = block_bytes
+        self._queue = Queue(max_blocks)
+        self._block = iter(())
+        self._error = None
+        self._closed = False
+        self._done = False
+
+        self._thread = threading.Thread(target=self._read)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self):
+        try:
+            while not self._closed:
+                lines = self._fileobj.readlines(self._block_bytes)
+                if not lines:
+                    break
+                self._queue.put(lines)
+        except Exception:
+            self._error = sys.exc_info()
+        finally:
+            self._queue.put(None)
+
+    def readline(self):
+        for line in self._block:
+            return line
+
+        while not self._done:
+            lines = self._queue.get()
+            if lines is None:
+                self._done = True
+                if self._error is not None:
+                    raise self._error[0], self._error[1], self._error[2]
+            elif lines:
+                self._block = iter(lines)
+                return self._block.next()
+
+        return ''
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        self._closed = True
+        # let the thread finish its last put.
+        while not self._done:
+            self._done = self._queue.get() is None
+
+        self._thread.join()
+        self._fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_writer(filename, mode='w', batch_lines=10000, max_pending=4, **open_args):
+    """
+    open_file(filename, mode, **open_args) for writing lines through a BackgroundWriter.
+    """
+    return BackgroundWriter(open_file(filename, mode, **open_args), batch_lines=batch_lines, max_pending=max_pending)
+
+
+class BackgroundWriter(object):
+    """
+    Write to fileobj in a background thread. The strings given to write() are collected into batches of
+    batch_lines, joined into one buffer and handed to the thread through a queue of at most max_pending buffers,
+    so the formatting of the rows runs at the same time as the writing (and compression) of the previous ones,
+    and write() waits when the disk falls behind.
+
+    An error of the thread is raised by the next write() or by close(). fileobj is closed by close().
+    """
+    def __init__(self, fileobj, batch_lines=10000, max_pending=4):
+        self._fileobj = fileobj
+        self._batch_lines = batch_lines
+        self._lines = []
+        self._queue = Queue(max_pending)
+        self._error = None
+
+        self._thread = threading.Thread(target=self._write_buffers)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write_buffers(self):
+        while True:
+            buf = self._queue.get()
+            if buf is None:
+                return
+
+            # after an error, keep taking the buffers so that the writer side does not wait forever.
+            if self._error is None:
+                try:
+                    self._fileobj.write(buf)
+                except Exception:
+                    self._error = sys.exc_info()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def _submit(self):
+        self._raise_error()
+        self._queue.put(''.join(self._lines))
+        self._lines = []
+
+    def write(self, line):
+        self._lines.append(line)
+        if len(self._lines) >= self._batch_lines:
+            self._submit()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def close(self):
+        if self._thread is None:
+            return
+
+        try:
+            if self._lines:
+                self._queue.put(''.join(self._lines))
+                self._lines = []
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._fileobj.close()
+
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
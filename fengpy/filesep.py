@@ -2,13 +2,79 @@
 
 """
 This will be used as a command line tool to only extract specific lines in a file
+
+With a line index (use_index=True, or --index in the command line), a sidecar file <input_file>.lidx keeps the
+byte offset of every index_step-th line. It's built the first time and rebuilt when the input file's size or
+mtime changes. So the repeated extractions only read the lines we ask for.
+
+Compressed input files are read through fileio.open_file. The index is not used for them, seeking in a
+compressed file has to decompress everything before the offset anyway.
 """
+from array import array
+import json
+import os
 import sys
 
+try:
+    from .fileio import compression_of, open_file
+except ValueError:
+    # run as a script, not as a module of the package.
+    from fileio import compression_of, open_file
+
+INDEX_SUFFIX = '.lidx'
+
+
+def build_line_index(input_file, step=1000):
+    """
+    Build the sidecar index of input_file. offsets[i] is the byte offset of line i * step + 1.
+    """
+    offsets = array('L')
+    offset = 0
+    with open(input_file, 'rb') as fin:
+        for cnt, line in enumerate(fin):
+            if cnt % step == 0:
+                offsets.append(offset)
+            offset += len(line)
+
+    stat = os.stat(input_file)
+    with open(input_file + INDEX_SUFFIX, 'wb') as fout:
+        fout.write('%s\n' % json.dumps({'size': stat.st_size, 'mtime': stat.st_mtime, 'step': step}))
+        offsets.tofile(fout)
+
+    return step, offsets
+
 
-def get_lines(input_file, start, end):
-    with open(input_file) as fin:
+def load_line_index(input_file, step=1000):
+    """
+    Return (step, offsets) from the sidecar index. It's (re)built if missing, stale or built with another step.
+    """
+    stat = os.stat(input_file)
+    try:
+        with open(input_file + INDEX_SUFFIX, 'rb') as fin:
+            meta = json.loads(fin.readline())
+            if meta['size'] == stat.st_size and meta['mtime'] == stat.st_mtime and meta['step'] == step:
+                offsets = array('L')
+                offsets.fromstring(fin.read())
+                return step, offsets
+    except (IOError, ValueError, KeyError):
+        pass
+
+    return build_line_index(input_file, step=step)
+
+
+def get_lines(input_file, start, end, use_index=False, index_step=1000):
+    # no index for compressed files or pipes.
+    use_index = use_index and os.path.isfile(input_file) and compression_of(input_file) is None
+
+    with open_file(input_file, 'rb' if use_index else 'r') as fin:
         cnt = 0
+        if use_index:
+            step, offsets = load_line_index(input_file, step=index_step)
+            block = min((max(start, 1) - 1) / step, len(offsets) - 1)
+            if block > 0:
+                fin.seek(offsets[block])
+                cnt = block * step
+
         for line in fin:
             cnt += 1
             if start <= cnt <= end:
@@ -19,8 +85,9 @@ def get_lines(input_file, start, end):
 
 if __name__ == "__main__":
 
-    if len(sys.argv) < 4:
-        print 'Usage: filesep input output start end'
-    else:
-        get_lines(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
+    args = [arg for arg in sys.argv[1:] if arg != '--index']
 
+    if len(args) < 3:
+        print 'Usage: filesep input start end [--index]'
+    else:
+        get_lines(args[0], int(args[1]), int(args[2]), use_index='--index' in sys.argv)
@@ -1,116 +1,665 @@
-from itertools import izip, chain
+from collections import OrderedDict, deque, namedtuple
+from cStringIO import StringIO
+from itertools import izip, chain, groupby, islice
+from multiprocessing import Pool
+import cPickle
+import heapq
 import json
+import mmap
+import os
+import shutil
+import tempfile
+import zlib
 
+try:
+    import ujson as fast_json
+except ImportError:
+    fast_json = json
 
-def tsv_2_dict_iterator(filename, names=None, delimiter='\t', has_header=True, strict=True, use_header_as_schema=False, chars=None, ignore_quotes=False):
+from .fileio import compression_of, open_file, open_writer
+from .tools import chunker
+
+
+def tsv_2_dict_iterator(filename, names=None, delimiter='\t', has_header=True, strict=True, use_header_as_schema=False, chars=None, ignore_quotes=False,
+                        processes=None, ordered=True, map_func=None, chunk_bytes=64 << 20, columns=None):
     """
     Either names is a list, or both has_header and use_header_as_schema are true. In the latter case, we will
     use the provided schema in the data file as the dictionary's schema.
+
+    processes: if set, the file is cut into byte ranges (about chunk_bytes each, aligned to line ends) that are
+    parsed in a pool of worker processes. Compressed files (see fileio.open_file) are always read serially.
+    ordered=False yields the ranges as soon as they are done.
+    map_func: applied to every dictionary (in the workers in the parallel mode), and its results are yielded
+    instead. It has to be picklable (a module level function) in the parallel mode.
+    columns: only put these names into the dictionaries. The lines are only split up to the last of them.
+    """
+    with open_file(filename) as fin:
+        if has_header:
+            # readline instead of next() so that fin.tell() is still right for the parallel mode.
+            line = fin.readline()
+            if use_header_as_schema:
+                names = line.strip(chars).split(delimiter)
+
+        if processes and isinstance(fin, file):
+            ranges = _line_aligned_ranges(fin, chunk_bytes, processes)
+        else:
+            for row in _parse_lines(fin, 'dict', names, delimiter, strict, chars, ignore_quotes, map_func, columns):
+                yield row
+            return
+
+    for row in _parse_ranges_parallel(filename, ranges, processes, ordered,
+                                      ('dict', names, delimiter, strict, chars, ignore_quotes, map_func, columns)):
+        yield row
+
+
+def tsv_2_tuple_iterator(filename, column_cnt, delimiter='\t', has_header=False, strict=True,
+                         processes=None, ordered=True, map_func=None, chunk_bytes=64 << 20):
+    """
+    I like to see if the tuple one can be faster.
+
+    processes, ordered, map_func and chunk_bytes work the same way as in tsv_2_dict_iterator.
+    """
+    with open_file(filename) as fin:
+        if has_header:
+            fin.readline()
+
+        if processes and isinstance(fin, file):
+            ranges = _line_aligned_ranges(fin, chunk_bytes, processes)
+        else:
+            for row in _parse_lines(fin, 'tuple', column_cnt, delimiter, strict, None, False, map_func):
+                yield row
+            return
+
+    for row in _parse_ranges_parallel(filename, ranges, processes, ordered,
+                                      ('tuple', column_cnt, delimiter, strict, None, False, map_func)):
+        yield row
+
+
+def _parse_lines(lines, kind, names, delimiter, strict, chars, ignore_quotes, map_func, columns=None):
+    """
+    The line loop shared by the readers. kind is 'dict' (names is the list of names) or 'tuple' (names is the
+    column count). columns is the projection of the dict reader.
     """
     if ignore_quotes:
         import csv
 
-    with open(filename) as fin:
+    column_cnt = len(names) if kind == 'dict' else names
+
+    maxsplit = -1
+    if columns is not None:
+        projection = [(column, names.index(column)) for column in columns]
+        if not ignore_quotes:
+            maxsplit = max(index for _, index in projection) + 1
+
+    for line in lines:
+        if ignore_quotes:
+            splited = csv.reader([line.strip()], delimiter=delimiter).next()
+            observed_cnt = len(splited)
+        else:
+            stripped = line.strip(chars)
+            splited = stripped.split(delimiter, maxsplit)
+            observed_cnt = len(splited) if maxsplit < 0 else stripped.count(delimiter) + 1
+
+        if strict and observed_cnt != column_cnt:
+            print 'Warning. wrong columns, expected column cnt %d, observed %d: %s' % \
+                  (column_cnt, observed_cnt, line),
+            continue
+
+        if kind == 'tuple':
+            row = splited
+        elif columns is None:
+            row = dict(izip(names, splited))
+        else:
+            row = dict((column, splited[index]) for column, index in projection if index < len(splited))
+
+        yield row if map_func is None else map_func(row)
+
+
+def _line_aligned_ranges(fin, chunk_bytes, processes):
+    """
+    Cut the rest of the file (from the current position of fin) into [begin, end) byte ranges. Each range
+    starts at the beginning of a line.
+    """
+    begin = fin.tell()
+    size = os.fstat(fin.fileno()).st_size
+    cnt = max(processes, (size - begin) / chunk_bytes)
+    step = max(1, (size - begin) / cnt)
+
+    ranges = []
+    while begin < size:
+        fin.seek(min(begin + step, size))
+        fin.readline()
+        end = min(fin.tell(), size)
+        ranges.append((begin, end))
+        begin = end
+
+    return ranges
+
+
+def _parse_range(args):
+    """
+    Worker side of the parallel readers. It parses the lines in one byte range and returns a list.
+    """
+    filename, begin, end, parse_args = args
+    with open_file(filename) as fin:
+        fin.seek(begin)
+        return list(_parse_lines(StringIO(fin.read(end - begin)), *parse_args))
+
+
+def _parse_ranges_parallel(filename, ranges, processes, ordered, parse_args):
+    pool = Pool(processes)
+    try:
+        tasks = ((filename, begin, end, parse_args) for begin, end in ranges)
+        for rows in _bounded_imap(pool, _parse_range, tasks, 2 * processes, ordered=ordered):
+            for row in rows:
+                yield row
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _bounded_imap(pool, func, tasks, max_pending, ordered=True):
+    """
+    Like pool.imap (or imap_unordered), but the tasks are submitted from the calling thread, at most max_pending
+    ahead of the results taken by the caller. pool.imap takes all the tasks and keeps all the results nobody
+    has asked for yet, so the memory is not bounded when the caller is slower than the pool.
+    """
+    tasks = iter(tasks)
+    pending = deque(pool.apply_async(func, (task,)) for task in islice(tasks, max_pending))
+
+    while pending:
+        # unordered, a result that is already done goes first, otherwise we wait for the oldest one.
+        result = None if ordered else next((result for result in pending if result.ready()), None)
+        if result is None:
+            result = pending.popleft()
+        else:
+            pending.remove(result)
+
+        for task in islice(tasks, 1):
+            pending.append(pool.apply_async(func, (task,)))
+
+        yield result.get()
+
+
+def tsv_2_view_iterator(filename, delimiter='\t', has_header=False, columns=None):
+    """
+    A memory mapped reader for scans that only look at a few columns. Each line is yielded as a RowView, whose
+    fields are sliced out of the mapped file only when they are asked for. If columns (a list of column indices)
+    is given, only these fields are taken, and a tuple of them is yielded instead.
+
+    Different from tsv_2_tuple_iterator, the lines are not stripped (only the '\n' or '\r\n' is taken off), and
+    the views can not be used after the iteration is done. Only works for plain (not compressed) files.
+    """
+    with open(filename, 'rb') as fin:
+        size = os.fstat(fin.fileno()).st_size
+        if size == 0:
+            return
+        buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        pos = 0
         if has_header:
-            line = iter(fin).next()
-            if use_header_as_schema:
-                names = line.strip(chars).split(delimiter)
+            pos = buf.find('\n') + 1 or size
 
-        column_cnt = len(names)
+        while pos < size:
+            end = buf.find('\n', pos)
+            if end < 0:
+                end = size
+            next_pos = end + 1
 
-        for line in fin:
-            if ignore_quotes:
-                splited = csv.reader([line.strip()], delimiter=delimiter).next()
-            else:
-                splited = line.strip(chars).split(delimiter)
+            if end > pos and buf[end - 1] == '\r':
+                end -= 1
 
-            if strict and len(splited) != column_cnt:
-                print 'Warning. wrong columns, expected column cnt %d, observed %d: %s' % \
-                      (column_cnt, len(splited), line),
+            row = RowView(buf, pos, end, delimiter)
+            yield row if columns is None else row.fields(columns)
+            pos = next_pos
+    finally:
+        buf.close()
+
+
+class RowView(object):
+    """
+    A line of a memory mapped file, see tsv_2_view_iterator. row[i] gives the i-th field (a str), the delimiters
+    are only searched up to the field we want. tuple(row) or list(row) gives all the fields.
+    """
+    __slots__ = ('_buf', '_end', '_delimiter', '_starts')
+
+    def __init__(self, buf, start, end, delimiter):
+        self._buf = buf
+        self._end = end
+        self._delimiter = delimiter
+        # starts of the fields found so far. The field after the last one "starts" at end + len(delimiter).
+        self._starts = [start]
+
+    def __getitem__(self, index):
+        starts = self._starts
+        delimiter_len = len(self._delimiter)
+
+        while len(starts) <= index + 1 and starts[-1] <= self._end:
+            pos = self._buf.find(self._delimiter, starts[-1], self._end)
+            starts.append((self._end if pos < 0 else pos) + delimiter_len)
+
+        if index < 0 or index + 1 >= len(starts):
+            raise IndexError('RowView index out of range')
+
+        return self._buf[starts[index]: starts[index + 1] - delimiter_len]
+
+    def _split(self):
+        return self._buf[self._starts[0]: self._end].split(self._delimiter)
+
+    def __iter__(self):
+        return iter(self._split())
+
+    def __len__(self):
+        return len(self._split())
+
+    def fields(self, indices):
+        """
+        A tuple of the fields at indices.
+        """
+        return tuple(self[index] for index in indices)
+
+    def __repr__(self):
+        return 'RowView(%r)' % self._buf[self._starts[0]: self._end]
+
+
+class TsvSchema(object):
+    """
+    A typed schema of tsv lines. columns is a list of (name, converter, default) or
+    (name, converter, default, numpy dtype) tuples. converter turns the field string into its value (ex. int,
+    float, or None to keep the string) and default is used when the field is empty.
+
+    The schema is compiled into one function, parse(splitted), that makes a record (a namedtuple, so no dict per
+    row) of the converted values of a splitted line.
+    """
+    _NUMPY_TYPES = {int: 'i8', long: 'i8', float: 'f8', bool: '?'}
+
+    def __init__(self, columns, record_name='Record'):
+        self.columns = [tuple(column) for column in columns]
+        self.names = [column[0] for column in self.columns]
+        self.record = namedtuple(record_name, self.names)
+        self.parse = self._compile()
+
+    def _compile(self):
+        namespace = {'Record': self.record}
+        fields = []
+
+        for index, column in enumerate(self.columns):
+            name, converter, default = column[:3]
+            namespace['default%d' % index] = default
+            if converter is None:
+                fields.append('f[%d] or default%d' % (index, index))
             else:
-                yield dict(izip(names, splited))
+                namespace['convert%d' % index] = converter
+                fields.append('convert%d(f[%d]) if f[%d] else default%d' % (index, index, index, index))
 
+        exec 'def parse(f):\n    return Record(%s)\n' % ', '.join(fields) in namespace
+        return namespace['parse']
 
-def tsv_2_tuple_iterator(filename, column_cnt, delimiter='\t', has_header=False, strict=True):
+    @property
+    def dtype(self):
+        """
+        The numpy dtype of the records: the 4th item of a column, or from its converter (object if unknown).
+        """
+        import numpy as np
+
+        return np.dtype([(column[0], column[3] if len(column) > 3 else self._NUMPY_TYPES.get(column[1], object))
+                         for column in self.columns])
+
+
+def typed_tsv_iterator(filename, schema, delimiter='\t', has_header=False, strict=True):
     """
-    I like to see if the tuple one can be faster.
+    Read a tsv file into records of a TsvSchema, with the values already converted. Lines with the wrong column
+    count (if strict) or values that can not be converted are skipped with a warning.
     """
-    with open(filename) as fin:
+    parse = schema.parse
+    column_cnt = len(schema.columns)
+
+    with open_file(filename) as fin:
         if has_header:
-            iter(fin).next()
+            fin.readline()
 
         for line in fin:
-            splited = line.strip().split(delimiter)
+            splited = line.rstrip('\r\n').split(delimiter)
 
             if strict and len(splited) != column_cnt:
                 print 'Warning. wrong columns, expected column cnt %d, observed %d: %s' % \
                       (column_cnt, len(splited), line),
-            else:
-                yield splited
+                continue
+
+            try:
+                record = parse(splited)
+            except (ValueError, TypeError, IndexError) as e:
+                print 'Warning. can not parse %s: %s' % (e, line),
+                continue
+
+            yield record
+
+
+def typed_tsv_2_structured_arrays(filename, schema, batch_size=100000, **reader_args):
+    """
+    Collect the records of typed_tsv_iterator into numpy structured arrays (schema.dtype) of batch_size rows.
+    reader_args go to typed_tsv_iterator.
+    """
+    import numpy as np
+
+    dtype = schema.dtype
+    for batch in chunker(batch_size, typed_tsv_iterator(filename, schema, **reader_args)):
+        # a list, numpy would take the tuple of records as one record.
+        yield np.array(list(batch), dtype=dtype)
 
 
 def json_file_iterator(filename):
     """
     Each line of the file is a json string.
     """
-    with open(filename) as fin:
+    with open_file(filename) as fin:
         for line in fin:
             yield json.loads(line.strip())
 
 
+def json_file_batch_iterator(filename, fields=None, converters=None, processes=None, batch_lines=10000, errors=None):
+    """
+    The fast version of json_file_iterator. The lines are decoded batch_lines at a time (in a pool of processes if
+    processes is set, the order is kept), with ujson when it's installed.
+
+    fields: a list of keys to project every object to, it then yields tuples of their values (None if missing)
+    instead of the objects. A nested key is a path 'a.b.c' or a tuple ('a', 'b', 0) (0 is a list index).
+    converters: a list of functions (or None) for the projected values, ex. [int, float, None]. They have to be
+    picklable in the parallel mode.
+    Malformed lines (and values the converters fail on) are skipped, and counted in errors['malformed'] if errors
+    (ex. a collections.Counter) is given. Empty lines are ignored.
+    """
+    paths = None
+    if fields is not None:
+        paths = [tuple(field.split('.')) if isinstance(field, basestring) else tuple(field) for field in fields]
+
+    with open_file(filename) as fin:
+        tasks = ((lines, paths, converters) for lines in chunker(batch_lines, fin))
+
+        if processes:
+            # the batches are read from fin here, at most 2 * processes ahead (see _bounded_imap).
+            pool = Pool(processes)
+            blocks = _bounded_imap(pool, _decode_json_lines, tasks, 2 * processes)
+        else:
+            pool = None
+            blocks = (_decode_json_lines(task) for task in tasks)
+
+        try:
+            for rows, malformed in blocks:
+                if malformed and errors is not None:
+                    errors['malformed'] = errors.get('malformed', 0) + malformed
+                for row in rows:
+                    yield row
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+
+def json_file_2_columns(filename, fields, dtypes, **reader_args):
+    """
+    Read the fields (see json_file_batch_iterator) of a json lines file into numpy arrays, one for each field,
+    with dtypes (ex. [np.int64, np.float32, object]). Missing values must be allowed by the dtype (float nan or
+    object), or be filled by converters.
+    :return: a dictionary of field -> array.
+    """
+    import numpy as np
+
+    rows = json_file_batch_iterator(filename, fields=fields, **reader_args)
+    columns = zip(*rows) or [()] * len(fields)
+
+    return dict((field, np.array(column, dtype=dtype)) for field, column, dtype in izip(fields, columns, dtypes))
+
+
+def _decode_json_lines(args):
+    """
+    Decode (and project) a block of json lines. Returns the rows and the count of malformed lines.
+    """
+    lines, paths, converters = args
+    rows = []
+    malformed = 0
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            obj = fast_json.loads(line)
+            if paths is not None:
+                obj = tuple(_json_path_value(obj, path) for path in paths)
+                if converters is not None:
+                    obj = tuple(value if value is None or convert is None else convert(value)
+                                for value, convert in izip(obj, converters))
+        except (ValueError, TypeError):
+            malformed += 1
+            continue
+
+        rows.append(obj)
+
+    return rows, malformed
+
+
+def _json_path_value(obj, path):
+    for key in path:
+        if isinstance(obj, dict):
+            obj = obj.get(key)
+        elif isinstance(obj, list) and (isinstance(key, int) or key.lstrip('-').isdigit()):
+            index = int(key)
+            if not -len(obj) <= index < len(obj):
+                return None
+            obj = obj[index]
+        else:
+            return None
+
+    return obj
+
+
 def iter_2_tsv(data_store, filename, columns, delimiter='\t', has_header=False):
     """
     data store is an iterator of dictionaries. Each small dictionary contains keys that are the 'columns'.
     'columns' should be a list or tuple of column names (strings). It determines the order of the columns in each line.
     """
-    with open(filename, 'w') as fout:
+    with open_writer(filename) as fout:
         if has_header:
             fout.write('%s\n' % delimiter.join(columns))
 
         for features in data_store:
-            fout.write('%s\n' % delimiter.join(str(features[column]) for column in columns))
+            fout.write('%s\n' % delimiter.join(_field_str(features[column]) for column in columns))
+
+
+def _field_str(value):
+    """
+    str() of a field, unicode is written as utf-8 (see stable_hash).
+    """
+    return value.encode('utf-8') if isinstance(value, unicode) else str(value)
 
 
 def tuple_iter_2_tsv(data_store, filename, delimiter='\t', has_header=False, header=None):
 
-    with open(filename, 'w') as fout:
+    with open_writer(filename) as fout:
         if has_header:
             fout.write('%s\n' % delimiter.join(header))
 
         for features in data_store:
-            fout.write('%s\n' % delimiter.join(str(column) for column in features))
+            fout.write('%s\n' % delimiter.join(_field_str(column) for column in features))
 
 
-def iter_2_tsv_shards(data_store, filename_prefix, columns, sharding_col, delimiter='\t', splits=100, mode='w'):
+def iter_2_tsv_shards(data_store, filename_prefix, columns, sharding_col, delimiter='\t', splits=100, mode='w', **writer_args):
     """
     data store is an iterator of dictionaries. Each small dictionary contains keys that are the 'columns'.
     'columns' should be a list or tuple of column names (strings). It determines the order of the columns in each line.
 
-    sharding_col: The key to which we are going to shard on. (get hashcode on that).
+    sharding_col: The key to which we are going to shard on. (get stable_hash on that).
     splits: number of files that are going to be written to.
     mode: 'w', or 'a' depends on whether we want to keep the original data of the files.
+    writer_args: passed to ShardWriter (buffer_bytes, max_open etc.)
     """
+    with ShardWriter(filename_prefix, splits=splits, mode=mode, **writer_args) as writer:
+        for record in data_store:
+            writer.write(record[sharding_col], '%s\n' % delimiter.join(_field_str(record[column]) for column in columns))
 
-    fouts = [open(filename_prefix + str(split), mode) for split in xrange(splits)]
 
-    for record in data_store:
-        index = hash(record[sharding_col]) % splits
-        fouts[index].write('%s\n' % delimiter.join(str(record[column]) for column in columns))
+def tuple_iter_2_tsv_shards(data_store, filename_prefix, sharding_col, delimiter='\t', splits=100, mode='w', **writer_args):
 
-    for fout in fouts:
-        fout.close()
+    with ShardWriter(filename_prefix, splits=splits, mode=mode, **writer_args) as writer:
+        for record in data_store:
+            writer.write(record[sharding_col], '%s\n' % delimiter.join(record))
 
 
-def tuple_iter_2_tsv_shards(data_store, filename_prefix, sharding_col, delimiter='\t', splits=100, mode='w'):
+def tsv_files_2_shards(filenames, filename_prefix, sharding_col, delimiter='\t', splits=100, mode='w', has_header=False,
+                       processes=None, **writer_args):
+    """
+    Shard several tsv files in parallel, one worker process for each file. The lines are copied as they are.
+    sharding_col is the index of the column to shard on. It goes to the same shards as the other sharding
+    functions with the same key.
 
-    fouts = [open(filename_prefix + str(split), mode) for split in xrange(splits)]
+    Each worker writes its own set of part shards, then the parts of each shard are put together (also in the
+    pool) into filename_prefix + str(split).
+    """
+    part_prefixes = ['%s.part%d.' % (filename_prefix, i) for i in xrange(len(filenames))]
 
-    for record in data_store:
-        index = hash(record[sharding_col]) % splits
-        fouts[index].write('%s\n' % delimiter.join(record))
+    pool = Pool(processes)
+    try:
+        pool.map(_shard_one_file, [(filename, part_prefix, sharding_col, delimiter, splits, has_header, writer_args)
+                                   for filename, part_prefix in izip(filenames, part_prefixes)], chunksize=1)
+        pool.map(_concat_shard_parts, [(filename_prefix + str(split), [prefix + str(split) for prefix in part_prefixes], mode)
+                                       for split in xrange(splits)])
+    finally:
+        pool.terminate()
+        pool.join()
 
-    for fout in fouts:
-        fout.close()
+
+def _shard_one_file(args):
+    filename, part_prefix, sharding_col, delimiter, splits, has_header, writer_args = args
+
+    with open_file(filename) as fin, ShardWriter(part_prefix, splits=splits, **writer_args) as writer:
+        if has_header:
+            fin.readline()
+
+        for line in fin:
+            if not line.endswith('\n'):
+                line += '\n'
+            # the key is read the same way as the tsv readers do.
+            writer.write(line.strip().split(delimiter, sharding_col + 1)[sharding_col], line)
+
+
+def _concat_shard_parts(args):
+    shard_name, part_names, mode = args
+
+    # the parts are copied as bytes, gzip shards (see ShardWriter) can be concatenated too.
+    with open(shard_name, mode + 'b') as fout:
+        for part_name in part_names:
+            with open(part_name, 'rb') as fin:
+                shutil.copyfileobj(fin, fout, 1 << 20)
+            os.remove(part_name)
+
+
+def stable_hash(value):
+    """
+    A hash of str(value) that is the same on every machine and in every run, unlike hash(). So 5 and '5' go to
+    the same shard, which is what we want when the key is read back from a tsv file. unicode is hashed as utf-8,
+    so u'caf\xe9' goes where the utf-8 'caf\xc3\xa9' read from a file goes.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+
+    return zlib.crc32(str(value)) & 0xffffffff
+
+
+class ShardWriter(object):
+    """
+    Write lines into splits shard files (filename_prefix + str(split)), the shard is picked by stable_hash(key).
+
+    The lines are buffered per shard and written in big blocks, when a shard has buffer_bytes, or all the
+    shards together have max_buffered_bytes. At most max_open files are open at the same time, the least
+    recently used one is closed when we need another one.
+
+    With compresslevel (1 to 9), the shards are written as gzip files. The readers find that out by themselves.
+    """
+    def __init__(self, filename_prefix, splits=100, mode='w', buffer_bytes=1 << 18, max_buffered_bytes=1 << 28,
+                 max_open=256, compresslevel=None):
+        self.filename_prefix = filename_prefix
+        self.splits = splits
+        self.mode = mode
+        self.buffer_bytes = buffer_bytes
+        self.max_buffered_bytes = max_buffered_bytes
+        self.max_open = max_open
+        self.compresslevel = compresslevel
+
+        self._buffers = [[] for _ in xrange(splits)]
+        self._buffer_sizes = [0] * splits
+        self._buffered_bytes = 0
+        # shard index -> file, in the order of last use.
+        self._handles = OrderedDict()
+        # after the first open of a shard, it's opened with 'a'.
+        self._opened = [False] * splits
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, key, line):
+        """
+        line should have its '\n'.
+        """
+        index = stable_hash(key) % self.splits
+        self._buffers[index].append(line)
+        self._buffer_sizes[index] += len(line)
+        self._buffered_bytes += len(line)
+
+        if self._buffer_sizes[index] >= self.buffer_bytes:
+            self._flush(index)
+        elif self._buffered_bytes >= self.max_buffered_bytes:
+            self.flush()
+
+    def flush(self):
+        for index in xrange(self.splits):
+            if self._buffers[index]:
+                self._flush(index)
+
+    def close(self):
+        self.flush()
+
+        for handle in self._handles.itervalues():
+            handle.close()
+        self._handles.clear()
+
+        # like opening all the shards up front, the shards without any line still get created (or emptied).
+        for index in xrange(self.splits):
+            if not self._opened[index]:
+                self._open(index, self.mode).close()
+                self._opened[index] = True
+
+    def _flush(self, index):
+        self._get_handle(index).write(''.join(self._buffers[index]))
+
+        self._buffered_bytes -= self._buffer_sizes[index]
+        self._buffers[index] = []
+        self._buffer_sizes[index] = 0
+
+    def _get_handle(self, index):
+        handle = self._handles.pop(index, None)
+
+        if handle is None:
+            if len(self._handles) >= self.max_open:
+                self._handles.popitem(last=False)[1].close()
+
+            handle = self._open(index, 'a' if self._opened[index] else self.mode)
+            self._opened[index] = True
+
+        self._handles[index] = handle
+        return handle
+
+    def _open(self, index, mode):
+        if self.compresslevel is None:
+            return open(self.filename_prefix + str(index), mode)
+
+        # appending to a gzip file adds a new member, which is still a valid gzip file.
+        return open_file(self.filename_prefix + str(index), mode, compression='gzip', compresslevel=self.compresslevel)
 
 
 def tsv_shards_2_dict(filename_prefix, names, splits=100, delimiter='\t', strict=True):
@@ -139,21 +688,366 @@ def get_shards(filename_prefix, splits=100):
     return (filename_prefix + str(split) for split in xrange(splits))
 
 
+def map_reduce_shards(filename_prefix, map_func, combine_func, splits=100, processes=None):
+    """
+    Run map_func on every shard file name (see get_shards) in a process pool, and merge the results with
+    combine_func(a, b), ex. sum_2_dictionaries. The merging is a tree: each round combines the results in pairs,
+    also in the pool, so 100 shards are merged in 7 rounds instead of 99 steps in one process.
+
+    Both functions must be picklable (module level functions). Returns None when there is no shard.
+    """
+    pool = Pool(processes)
+    try:
+        partials = pool.map(map_func, list(get_shards(filename_prefix, splits)), chunksize=1)
+
+        while len(partials) > 1:
+            pairs = [(combine_func, partials[i], partials[i + 1]) for i in xrange(0, len(partials) - 1, 2)]
+            combined = pool.map(_combine_pair, pairs, chunksize=1)
+            if len(partials) % 2:
+                combined.append(partials[-1])
+            partials = combined
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return partials[0] if partials else None
+
+
+def _combine_pair(args):
+    combine_func, first, second = args
+    return combine_func(first, second)
+
+
+def external_sort(data_store, key=None, max_items_in_memory=1000000, tmp_dir=None):
+    """
+    Sort an iterator of (picklable) items with bounded memory, like sorted(data_store, key=key).
+    Every max_items_in_memory items are sorted and spilled to a temp file (a run), and the runs are merged with a
+    k-way heap merge. It's stable. Nothing is spilled when everything fits in one run.
+    """
+    key = key or (lambda item: item)
+    runs = []
+
+    try:
+        for chunk in chunker(max_items_in_memory, data_store):
+            chunk = sorted(chunk, key=key)
+            if not runs and len(chunk) < max_items_in_memory:
+                for item in chunk:
+                    yield item
+                return
+
+            run = tempfile.TemporaryFile(dir=tmp_dir)
+            for block in chunker(1000, chunk):
+                cPickle.dump(block, run, cPickle.HIGHEST_PROTOCOL)
+            run.seek(0)
+            runs.append(run)
+            del chunk
+
+        for decorated in heapq.merge(*[_read_run(run, index, key) for index, run in enumerate(runs)]):
+            yield decorated[3]
+    finally:
+        for run in runs:
+            run.close()
+
+
+def _read_run(run, index, key):
+    """
+    Yield (key, run index, position in the run, item) of a spilled run, so the items themselves are never compared.
+    """
+    position = 0
+    while True:
+        try:
+            block = cPickle.load(run)
+        except EOFError:
+            return
+        for item in block:
+            yield key(item), index, position, item
+            position += 1
+
+
+def _column_key(key_columns, key_types=None):
+    """
+    The sort/group key function of dictionaries. key_columns is a column name (the key is the value) or a list of
+    them (the key is a tuple). key_types maps column names to converters, ex. {'age': int}, the others are strings.
+    """
+    key_types = key_types or {}
+
+    if isinstance(key_columns, basestring):
+        convert = key_types.get(key_columns)
+        if convert is None:
+            return lambda row: row[key_columns]
+        return lambda row: convert(row[key_columns])
+
+    converters = [(column, key_types.get(column, lambda x: x)) for column in key_columns]
+    return lambda row: tuple(convert(row[column]) for column, convert in converters)
+
+
+def tsv_sort(input_name, output_name, names, key_columns, key_types=None, delimiter='\t', has_header=False,
+             max_rows_in_memory=1000000, tmp_dir=None):
+    """
+    Sort a tsv file that does not need to fit in memory, on key_columns (see _column_key). names are the columns
+    of the file (and the output).
+    """
+    rows = tsv_2_dict_iterator(input_name, names=names, delimiter=delimiter, has_header=has_header)
+    sorted_rows = external_sort(rows, key=_column_key(key_columns, key_types),
+                                max_items_in_memory=max_rows_in_memory, tmp_dir=tmp_dir)
+
+    iter_2_tsv(sorted_rows, output_name, names, delimiter=delimiter, has_header=has_header)
+
+
+def groupby_sorted(data_store, key_columns, key_types=None):
+    """
+    Group an iterator of dictionaries that is already sorted on key_columns. It yields (key, rows) where rows is an
+    iterator (itertools.groupby), so only one row is in memory at a time.
+    """
+    return groupby(data_store, key=_column_key(key_columns, key_types))
+
+
+def tsv_groupby(filename, names, key_columns, key_types=None, delimiter='\t', has_header=False, presorted=False,
+                max_rows_in_memory=1000000, tmp_dir=None):
+    """
+    Streaming group by of a tsv file. The file is sorted with external_sort first unless presorted is True.
+    """
+    rows = tsv_2_dict_iterator(filename, names=names, delimiter=delimiter, has_header=has_header)
+    if not presorted:
+        rows = external_sort(rows, key=_column_key(key_columns, key_types), max_items_in_memory=max_rows_in_memory,
+                             tmp_dir=tmp_dir)
+
+    return groupby_sorted(rows, key_columns, key_types=key_types)
+
+
+def tsv_shards_groupby(filename_prefix, names, key_columns, key_types=None, splits=100, delimiter='\t',
+                       max_rows_in_memory=1000000, tmp_dir=None):
+    """
+    Group by over the shards written by iter_2_tsv_shards. The shards must have been sharded on the group key
+    (or one of its columns), so that no group is split over two shards. Each shard is sorted and grouped alone.
+    """
+    return chain.from_iterable(tsv_groupby(shard, names, key_columns, key_types=key_types, delimiter=delimiter,
+                                           max_rows_in_memory=max_rows_in_memory, tmp_dir=tmp_dir)
+                               for shard in get_shards(filename_prefix, splits))
+
+
+def join_shards(left_prefix, right_prefix, left_names, right_names, key, splits=100, how='inner', delimiter='\t',
+                processes=None):
+    """
+    Join two shard sets that were sharded on key with the same number of splits (iter_2_tsv_shards etc.), so a
+    key is always in the same split on both sides. It yields dictionaries with the columns of both sides.
+
+    Each pair of shards is joined with an in memory hash table on the smaller shard file, so the peak memory is
+    about the biggest shard instead of the whole data set.
+    how: 'inner' or 'left'. In a left join, the right columns are None for the left rows without a match.
+    processes: join the shard pairs in a pool of processes.
+    The rows do not come out in any particular order.
+    """
+    # checked here, not on the first next() of the generator.
+    _check_join_args(left_names, right_names, key, how)
+    return _join_shards(left_prefix, right_prefix, left_names, right_names, key, splits, how, delimiter, processes)
+
+
+def _join_shards(left_prefix, right_prefix, left_names, right_names, key, splits, how, delimiter, processes):
+    tasks = [(left_prefix + str(split), right_prefix + str(split), left_names, right_names, key, how, delimiter)
+             for split in xrange(splits)]
+
+    if not processes:
+        for task in tasks:
+            for row in _join_shard_pair(*task):
+                yield row
+        return
+
+    pool = Pool(processes)
+    try:
+        for rows in pool.imap(_join_shard_pair_list, tasks):
+            for row in rows:
+                yield row
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _check_join_args(left_names, right_names, key, how):
+    """
+    how must be inner or left. The joined rows are dictionaries, so a column other than key can not be on both
+    sides.
+    """
+    if how not in ('inner', 'left'):
+        raise ValueError('how must be inner or left, not %s.' % how)
+
+    overlapping = sorted(set(left_names) & set(right_names) - {key})
+    if overlapping:
+        raise ValueError('The columns %s are on both sides of the join, rename them.' % ', '.join(overlapping))
+
+
+def _join_shard_pair_list(task):
+    return list(_join_shard_pair(*task))
+
+
+def _join_shard_pair(left_name, right_name, left_names, right_names, key, how, delimiter):
+    def read(filename, names):
+        return tsv_2_dict_iterator(filename, names=names, delimiter=delimiter, has_header=False)
+
+    def merge(left, right):
+        row = dict(left)
+        row.update(right)
+        return row
+
+    no_match = dict.fromkeys(name for name in right_names if name != key)
+
+    if os.path.getsize(right_name) <= os.path.getsize(left_name):
+        table = {}
+        for right in read(right_name, right_names):
+            table.setdefault(right[key], []).append(right)
+
+        for left in read(left_name, left_names):
+            matches = table.get(left[key])
+            if matches:
+                for right in matches:
+                    yield merge(left, right)
+            elif how == 'left':
+                yield merge(left, no_match)
+    else:
+        table = {}
+        for left in read(left_name, left_names):
+            table.setdefault(left[key], []).append(left)
+
+        matched = set()
+        for right in read(right_name, right_names):
+            matches = table.get(right[key])
+            if matches:
+                matched.add(right[key])
+                for left in matches:
+                    yield merge(left, right)
+
+        if how == 'left':
+            for left_key, lefts in table.iteritems():
+                if left_key not in matched:
+                    for left in lefts:
+                        yield merge(left, no_match)
+
+
+def tsv_join(left_name, right_name, left_names, right_names, key, how='inner', delimiter='\t', has_header=False,
+             splits=100, processes=None, tmp_dir=None):
+    """
+    Join two tsv files on the column key. Both files are sharded on key into a temp directory with the same hash,
+    and then joined shard by shard with join_shards (see there for how and processes). The temp shards are removed
+    when the iteration is done.
+    """
+    _check_join_args(left_names, right_names, key, how)
+    return _tsv_join(left_name, right_name, left_names, right_names, key, how, delimiter, has_header, splits,
+                     processes, tmp_dir)
+
+
+def _tsv_join(left_name, right_name, left_names, right_names, key, how, delimiter, has_header, splits, processes,
+              tmp_dir):
+    shard_dir = tempfile.mkdtemp(prefix='fengpy_join_', dir=tmp_dir)
+    try:
+        prefixes = []
+        for side, filename, names in (('left', left_name, left_names), ('right', right_name, right_names)):
+            prefixes.append(os.path.join(shard_dir, side))
+            rows = tsv_2_tuple_iterator(filename, len(names), delimiter=delimiter, has_header=has_header)
+            tuple_iter_2_tsv_shards(rows, prefixes[-1], names.index(key), delimiter=delimiter, splits=splits)
+
+        for row in join_shards(prefixes[0], prefixes[1], left_names, right_names, key, splits=splits, how=how,
+                               delimiter=delimiter, processes=processes):
+            yield row
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+
 def get_schema(input, delimiter='\t'):
-    with open(input) as fin:
+    with open_file(input) as fin:
         line = iter(fin).next()
         return line.strip().split(delimiter)
 
 
-def tsv_filter(input_name, output_name, names, keep, delimiter='\t', has_header=False):
+def tsv_filter(input_name, output_name, names, keep, delimiter='\t', has_header=False, keep_columns=None,
+               output_columns=None, processes=None, chunk_bytes=64 << 20):
     """
     Filter the input_name tsv file to put into output_name file.
     keep is a function whose input is the dictionary for each line. Output is to keep this data or not to.
+
+    keep_columns: only these columns are put into the dictionary for keep (the line is only split up to the last
+    one). output_columns: the columns to write out, all of names by default, in which case the kept lines are
+    written out as they are.
+    processes: filter the byte ranges of the file (see tsv_2_dict_iterator) in a pool of processes. keep has to
+    be picklable then.
+    """
+    output_columns = output_columns or names
+    filter_args = (names, keep, delimiter, keep_columns, output_columns)
+
+    with open_file(input_name) as fin:
+        if has_header:
+            fin.readline()
+
+        if processes and isinstance(fin, file):
+            ranges = _line_aligned_ranges(fin, chunk_bytes, processes)
+        else:
+            with open_writer(output_name) as fout:
+                if has_header:
+                    fout.write('%s\n' % delimiter.join(output_columns))
+                fout.writelines(_filter_lines(fin, *filter_args))
+            return
+
+    # gzip members can be concatenated, but python 2 only reads the first stream of a bz2 or xz file, so their
+    # parts are written plain and compressed once here.
+    compression = compression_of(output_name, 'w')
+    part_compression = compression if compression == 'gzip' else None
+    tasks = [(input_name, begin, end, '%s.part%d' % (output_name, index), part_compression, filter_args)
+             for index, (begin, end) in enumerate(ranges)]
+
+    pool = Pool(processes)
+    try:
+        part_names = pool.map(_filter_range, tasks, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    with open_file(output_name, 'w') as fout:
+        if has_header:
+            fout.write('%s\n' % delimiter.join(output_columns))
+
+        if part_compression != compression:
+            for part_name in part_names:
+                with open(part_name, 'rb') as fin:
+                    shutil.copyfileobj(fin, fout, 1 << 20)
+                os.remove(part_name)
+
+    if part_compression == compression:
+        _concat_shard_parts((output_name, part_names, 'a'))
+
+
+def _filter_range(args):
+    input_name, begin, end, part_name, compression, filter_args = args
+
+    with open(input_name) as fin, open_writer(part_name, compression=compression) as fout:
+        fin.seek(begin)
+        fout.writelines(_filter_lines(StringIO(fin.read(end - begin)), *filter_args))
+
+    return part_name
+
+
+def _filter_lines(lines, names, keep, delimiter, keep_columns, output_columns):
+    """
+    The lines of tsv_filter's output. The rows are only split as far as keep needs, and the kept lines are written
+    out as they are if all the columns are wanted.
     """
-    raw_it = tsv_2_dict_iterator(input_name, names=names, delimiter=delimiter, has_header=has_header, strict=True, use_header_as_schema=False, chars=None)
+    column_cnt = len(names)
+    projection = [(column, names.index(column)) for column in keep_columns or names]
+    maxsplit = max(index for _, index in projection) + 1
+    output_indices = None if list(output_columns) == list(names) else [names.index(column) for column in output_columns]
 
-    filtered = (single for single in raw_it if keep(single))
+    for line in lines:
+        stripped = line.strip()
 
-    iter_2_tsv(filtered, output_name, names, delimiter=delimiter, has_header=has_header)
+        if stripped.count(delimiter) + 1 != column_cnt:
+            print 'Warning. wrong columns, expected column cnt %d, observed %d: %s' % \
+                  (column_cnt, stripped.count(delimiter) + 1, line),
+            continue
 
+        splited = stripped.split(delimiter, maxsplit)
+        if not keep(dict((column, splited[index]) for column, index in projection)):
+            continue
 
+        if output_indices is None:
+            yield '%s\n' % stripped
+        else:
+            splited = stripped.split(delimiter)
+            yield '%s\n' % delimiter.join([splited[index] for index in output_indices])
@@ -0,0 +1,128 @@
+"""
+Moving window (rolling) aggregates of 1-d numpy arrays. They are computed from running sums or block
+accumulations, so the cost does not grow with the window size, instead of aggregating every window again.
+
+The result i is the aggregate of arr[i: i + n], there are len(arr) - n + 1 of them.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def rolling_window(arr, n):
+    """
+    A read only view of arr with shape (len(arr) - n + 1, n), row i is arr[i: i + n]. Nothing is copied.
+    """
+    arr = np.asarray(arr)
+    _check_window(arr, n)
+
+    return as_strided(arr, shape=(arr.shape[0] - n + 1, n) + arr.shape[1:], strides=(arr.strides[0],) + arr.strides,
+                      writeable=False)
+
+
+def rolling_sum(arr, n):
+    """
+    From the running sum, in float64 (int64 for integers, which is exact).
+    """
+    arr = np.asarray(arr)
+    _check_window(arr, n)
+
+    dtype = np.int64 if np.issubdtype(arr.dtype, np.integer) else np.float64
+    cumsum = np.empty(len(arr) + 1, dtype=dtype)
+    cumsum[0] = 0
+    np.cumsum(arr, dtype=dtype, out=cumsum[1:])
+
+    return cumsum[n:] - cumsum[:-n]
+
+
+def rolling_mean(arr, n):
+    return rolling_sum(arr, n) / float(n)
+
+
+def rolling_std(arr, n, ddof=0):
+    """
+    The same block structure as rolling_max: the count, mean and sum of squared deviations (M2) of the prefixes
+    and suffixes of every block of n, with Welford's updates (a loop over the n columns, each step over all the
+    blocks at once), and a window is the merge of a suffix and a prefix with Chan's parallel formula. So it's
+    O(len(arr)) and stable, no running sums of squares that lose the precision on big offsets or trends.
+    """
+    arr = np.asarray(arr, dtype=np.float64)
+    _check_window(arr, n)
+
+    length = len(arr)
+    blocks = _blocks(arr, n)
+    prefix_mean, prefix_m2 = _welford_prefixes(blocks)
+    suffix_mean, suffix_m2 = [stat[:, ::-1] for stat in _welford_prefixes(blocks[:, ::-1])]
+
+    starts = np.arange(length - n + 1)
+    ends = starts + n - 1
+    # the window i is the suffix of its block from i (suffix_cnt values) and the prefix of the next block up to
+    # i + n - 1 (n - suffix_cnt values). A window starting at a block start is the whole block, the prefix alone.
+    suffix_cnt = n - starts % n
+    prefix_cnt = n - suffix_cnt
+
+    prefix_mean, prefix_m2 = prefix_mean.ravel()[ends], prefix_m2.ravel()[ends]
+    suffix_mean, suffix_m2 = suffix_mean.ravel()[starts], suffix_m2.ravel()[starts]
+
+    whole = prefix_cnt == 0
+    delta = prefix_mean - suffix_mean
+    m2 = np.where(whole, prefix_m2, suffix_m2 + prefix_m2 + np.square(delta) * suffix_cnt * prefix_cnt / float(n))
+
+    return np.sqrt(np.maximum(m2 / (n - ddof), 0))
+
+
+def _welford_prefixes(blocks):
+    """
+    The mean and M2 of blocks[:, :j + 1] for every j, by Welford's updates column by column.
+    """
+    mean = np.empty(blocks.shape)
+    m2 = np.empty(blocks.shape)
+
+    running_mean = np.zeros(blocks.shape[0])
+    running_m2 = np.zeros(blocks.shape[0])
+    for j in xrange(blocks.shape[1]):
+        x = blocks[:, j]
+        delta = x - running_mean
+        running_mean += delta / (j + 1)
+        running_m2 += delta * (x - running_mean)
+        mean[:, j] = running_mean
+        m2[:, j] = running_m2
+
+    return mean, m2
+
+
+def rolling_max(arr, n):
+    """
+    The van Herk/Gil-Werman algorithm: the prefix and suffix maximums of blocks of n, two passes whatever n is.
+    """
+    return _rolling_extreme(arr, n, np.maximum)
+
+
+def rolling_min(arr, n):
+    return _rolling_extreme(arr, n, np.minimum)
+
+
+def _rolling_extreme(arr, n, ufunc):
+    arr = np.asarray(arr)
+    _check_window(arr, n)
+
+    length = len(arr)
+    blocks = _blocks(arr, n)
+
+    prefix = ufunc.accumulate(blocks, axis=1).ravel()
+    suffix = ufunc.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+
+    return ufunc(suffix[:length - n + 1], prefix[n - 1: length])
+
+
+def _blocks(arr, n):
+    """
+    arr padded to whole blocks of n, as a (blocks, n) array. The padding never gets into a result: a window
+    reaching into the padding would be inside the last, partial block.
+    """
+    padded = np.concatenate((arr, np.repeat(arr[-1:], -len(arr) % n)))
+    return padded.reshape(-1, n)
+
+
+def _check_window(arr, n):
+    if not 1 <= n <= len(arr):
+        raise ValueError('The window size %d does not fit an array of %d.' % (n, len(arr)))
@@ -0,0 +1,224 @@
+"""
+Timing spans and row counters, to see where the wall time of a pipeline goes, and a summary report of them.
+
+    timing.enable()
+    with timing.span('load'):
+        rows = timing.count_rows(iters.tsv_2_dict_iterator(fname), 'rows')
+        ...
+    print timing.report()
+
+It's disabled by default. Then span() returns one shared no-op object, count_rows() returns the iterable itself
+and the functions decorated by timed() only check a flag, so they can be left in the hot loops.
+
+The spans nest by thread: a span opened inside another one is reported as 'outer/inner'. The stats of worker
+processes are merged by map_with_stats (or snapshot() in the worker and merge() in the parent).
+"""
+import functools
+import threading
+import time
+
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+
+# path -> [calls, seconds, rows]
+_stats = {}
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def snapshot():
+    """
+    A copy of the stats, {path: (calls, seconds, rows)}, it can be pickled to the parent process.
+    """
+    with _lock:
+        return dict((path, tuple(stat)) for path, stat in _stats.iteritems())
+
+
+def merge(stats):
+    """
+    Add the stats of a snapshot (ex. from a worker process) to the stats of this process.
+    """
+    for path, (calls, seconds, rows) in stats.iteritems():
+        _add(path, calls, seconds, rows)
+
+
+def _add(path, calls, seconds, rows):
+    with _lock:
+        stat = _stats.get(path)
+        if stat is None:
+            _stats[path] = [calls, seconds, rows]
+        else:
+            stat[0] += calls
+            stat[1] += seconds
+            stat[2] += rows
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _path_of(name):
+    stack = _stack()
+    return stack[-1] + '/' + name if stack else name
+
+
+class _NoOpSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NO_OP_SPAN = _NoOpSpan()
+
+
+class _Span(object):
+    __slots__ = ('path', 'start')
+
+    def __init__(self, name):
+        self.path = _path_of(name)
+        self.start = None
+
+    def __enter__(self):
+        _stack().append(self.path)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.time() - self.start
+        _stack().pop()
+        _add(self.path, 1, elapsed, 0)
+        return False
+
+
+def span(name):
+    """
+    A context manager that times its block under name (nested in the open spans of the thread).
+    """
+    if not _enabled:
+        return _NO_OP_SPAN
+    return _Span(name)
+
+
+def timed(name=None):
+    """
+    A decorator that runs the function in span(name), name is the function's name by default. Whether it's
+    enabled is checked at every call, not when the function is decorated.
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count_rows(iterable, name='rows'):
+    """
+    Count the items of iterable and the wall time from the first to the last one, for the rows/sec of the report.
+    The stats are recorded when the iteration ends (or the iterator is closed).
+    """
+    if not _enabled:
+        return iterable
+    return _count_rows(iterable, _path_of(name))
+
+
+def _count_rows(iterable, path):
+    cnt = 0
+    start = time.time()
+    try:
+        for item in iterable:
+            cnt += 1
+            yield item
+    finally:
+        _add(path, 1, time.time() - start, cnt)
+
+
+def map_with_stats(pool, func, iterable, chunksize=None):
+    """
+    pool.map(func, iterable), and merge the stats of the workers into this process. func has to be picklable, as
+    for pool.map. The workers time their calls even when the pool was started before enable().
+    """
+    if not _enabled:
+        return pool.map(func, iterable, chunksize)
+
+    results = pool.map(_WithStats(func), iterable, chunksize)
+    for _, stats in results:
+        merge(stats)
+
+    return [result for result, _ in results]
+
+
+class _WithStats(object):
+    """
+    Run func in a worker and return (result, the stats of this call).
+    """
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, arg):
+        global _enabled, _stats
+
+        # on for this call only, the worker can be reused for other tasks.
+        saved_enabled, saved_stats = _enabled, _stats
+        _enabled, _stats = True, {}
+        try:
+            result = self.func(arg)
+            return result, snapshot()
+        finally:
+            _enabled, _stats = saved_enabled, saved_stats
+
+
+def report(stats=None):
+    """
+    A table of the stats (the stats of this process by default): the calls, the seconds and their percent of the
+    top level total, and the rows and rows/sec of the counters. Nested paths are indented under their parents.
+    The seconds of merged worker stats add up over the workers, so they can be more than the wall time.
+    """
+    stats = snapshot() if stats is None else stats
+    if not stats:
+        return 'no timing stats.'
+
+    total = sum(seconds for path, (_, seconds, _) in stats.iteritems() if '/' not in path) or 1.0
+
+    lines = ['%-40s %10s %12s %7s %12s %12s' % ('span', 'calls', 'seconds', '%', 'rows', 'rows/sec')]
+    for path in sorted(stats, key=lambda path: path.split('/')):
+        calls, seconds, rows = stats[path]
+        depth = path.count('/')
+        label = '  ' * depth + path.rsplit('/', 1)[-1]
+        rate = '%12.1f' % (rows / seconds) if rows and seconds > 0 else '%12s' % ''
+        lines.append('%-40s %10d %12.4f %6.1f%% %12s %s' % (label, calls, seconds, 100.0 * seconds / total,
+                                                            rows if rows else '', rate))
+
+    return '\n'.join(lines)
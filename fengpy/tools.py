@@ -5,8 +5,13 @@ The small tools that I am going to use very often.
 
 import collections
 from itertools import izip_longest, islice, izip, chain
+from multiprocessing import Process, Queue as ProcessQueue
+from Queue import Queue, Empty, Full
+import cPickle
 import os
 import sys
+import threading
+import traceback
 from datetime import datetime
 
 
@@ -48,6 +53,154 @@ def chunker(n, iterable):
             break
 
 
+def array_chunker(n, iterable, width=None, dtype=None, columns=False, reuse=True):
+    """
+    The numpy version of chunker. The items are numbers, or sequences of width numbers (width is taken from the
+    first item if None), every chunk is put into a numpy array of dtype (float64 by default): shape (cnt,) for
+    numbers, (cnt, width) for sequences, or (width, cnt) with columns=True so that every column is contiguous.
+
+    With reuse, all the chunks are views of one preallocated buffer, copy a chunk if it has to be kept after the
+    next one is asked for.
+    """
+    import numpy as np
+
+    dtype = np.float64 if dtype is None else dtype
+    buf = None
+
+    for chunk in chunker(n, iterable):
+        if buf is None or not reuse:
+            if width is None:
+                width = None if np.ndim(chunk[0]) == 0 else len(chunk[0])
+            shape = (n,) if width is None else ((width, n) if columns else (n, width))
+            buf = np.empty(shape, dtype=dtype)
+
+        if columns and width is not None:
+            ret = buf[:, :len(chunk)]
+            ret.T[...] = chunk
+        else:
+            ret = buf[:len(chunk)]
+            ret[...] = chunk
+
+        yield ret
+
+
+def prefetch(iterable, buffer_size=8, chunk_size=256, use_process=False):
+    """
+    Iterate over iterable in a background thread (or a forked process with use_process), at most buffer_size
+    chunks of chunk_size items ahead of the caller, so a slow reader upstream runs at the same time as the
+    compute downstream. The items come out in the same order, an exception of the upstream is raised here.
+
+    A thread only helps when one side releases the GIL (io, decompression, most numpy work). A process always
+    runs in parallel, but the items are pickled, so it's for a heavy upstream with compact items (arrays, not
+    lots of small objects). The iterable is inherited by the fork, not pickled.
+
+    Note: with a thread, the items must not be changed by the upstream later, ex. the reused buffer of
+    array_chunker(reuse=True). With a process they are copies anyway.
+    """
+    if use_process:
+        return _prefetch_process(iterable, buffer_size, chunk_size)
+    return _prefetch_thread(iterable, buffer_size, chunk_size)
+
+
+def _prefetch_thread(iterable, buffer_size, chunk_size):
+    queue = Queue(buffer_size)
+    stopped = threading.Event()
+
+    def put(item):
+        # stop waiting when the caller is gone.
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def produce():
+        try:
+            for chunk in chunker(chunk_size, iterable):
+                put(('items', chunk))
+                if stopped.is_set():
+                    return
+            put(('done', None))
+        except Exception:
+            put(('error', sys.exc_info()))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            kind, value = queue.get()
+            if kind == 'items':
+                for item in value:
+                    yield item
+            elif kind == 'error':
+                raise value[0], value[1], value[2]
+            else:
+                return
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def _prefetch_process(iterable, buffer_size, chunk_size):
+    queue = ProcessQueue(buffer_size)
+    process = Process(target=_prefetch_produce, args=(iterable, queue, chunk_size))
+    process.daemon = True
+    process.start()
+
+    try:
+        while True:
+            kind, value = cPickle.loads(_get_from_process(queue, process))
+            if kind == 'items':
+                for item in value:
+                    yield item
+            elif kind == 'error':
+                raise value
+            else:
+                return
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+
+def _get_from_process(queue, process, poll_seconds=0.1):
+    """
+    The next message of the process, or RuntimeError if the process is gone without sending one (killed,
+    os._exit etc.), instead of waiting forever.
+    """
+    while True:
+        try:
+            return queue.get(timeout=poll_seconds)
+        except Empty:
+            if not process.is_alive():
+                break
+
+    # the last message could have come in just before it exited.
+    try:
+        return queue.get(timeout=poll_seconds)
+    except Empty:
+        raise RuntimeError('The prefetch process exited with code %s.' % process.exitcode)
+
+
+def _prefetch_produce(iterable, queue, chunk_size):
+    # pickled here, not later by the feeder thread of the queue, in case the upstream reuses its items.
+    def put(item):
+        queue.put(cPickle.dumps(item, cPickle.HIGHEST_PROTOCOL))
+
+    try:
+        for chunk in chunker(chunk_size, iterable):
+            put(('items', chunk))
+        put(('done', None))
+    except Exception as e:
+        try:
+            put(('error', e))
+        except Exception:
+            put(('error', RuntimeError(traceback.format_exc())))
+
+
 def segmenter(k, lst):
     """
     The differences of this one with chunker are,
@@ -67,18 +220,22 @@ def segmenter(k, lst):
     return ret
 
 
-def window(seq, n=2):
+def window(seq, n=2, as_deque=False):
     """
     to get a moving window for an iterable(iterator), use the following,
-    copied from itertools.examples.
+    it was copied from itertools.examples, now the window is kept in a deque.
+
+    Sliding the deque is O(1), but the tuple yielded for every step is still a copy of n items. With as_deque=True
+    the deque itself is yielded, so one step is O(1) whatever n is, but it's changed by the next step (copy it to
+    keep it). Use that for wide windows. For numpy arrays, see rolling.rolling_window.
     """
     it = iter(seq)
-    result = tuple(islice(it, n))
+    result = collections.deque(islice(it, n), maxlen=n)
     if len(result) == n:
-        yield result
+        yield result if as_deque else tuple(result)
     for elem in it:
-        result = result[1:] + (elem,)
-        yield result
+        result.append(elem)
+        yield result if as_deque else tuple(result)
 
 
 def cv_k_fold(data_size, k=5):
@@ -102,6 +259,61 @@ def cv_k_fold(data_size, k=5):
         yield list(training), testing
 
 
+def k_fold_indices(data_size, k=5, seed=None, labels=None, groups=None):
+    """
+    The numpy version of cv_k_fold, it yields (training, testing) index arrays for every fold. All the folds come
+    from one random permutation of np.random.RandomState(seed), so the same seed gives the same folds, and the
+    global random state is not touched.
+
+    With labels (one per row, an n x 1 column vector is fine too), the folds are stratified: every fold gets
+    about the same share of each label.
+    With groups (one per row, ex. the user id), all the rows of a group are in the same fold, every fold gets
+    about the same number of groups. Only one of them can be given.
+    """
+    import numpy as np
+
+    if labels is not None and groups is not None:
+        raise ValueError('Only one of labels and groups can be given.')
+
+    rng = np.random.RandomState(seed)
+    perm = rng.permutation(data_size)
+
+    if labels is None and groups is None:
+        # the testing folds are slices (views) of the permutation.
+        bounds = np.arange(k + 1) * data_size // k
+        for i in range(k):
+            start, end = bounds[i], bounds[i + 1]
+            yield np.concatenate((perm[:start], perm[end:])), perm[start: end]
+        return
+
+    fold_of = np.empty(data_size, dtype=np.intp)
+    if labels is not None:
+        labels = np.asarray(labels)
+        if labels.ndim > 1:
+            if labels.size != data_size:
+                raise ValueError('labels must have one value per row, got shape %s.' % (labels.shape,))
+            # a column vector (n x 1).
+            labels = labels.ravel()
+
+        # sort the shuffled rows by label and deal them out round robin, so every label is spread evenly.
+        by_label = perm[np.argsort(labels[perm], kind='mergesort')]
+        fold_of[by_label] = np.arange(data_size) % k
+    else:
+        unique_groups, group_ids = np.unique(groups, return_inverse=True)
+        if len(unique_groups) < k:
+            raise ValueError('%d groups can not make %d folds.' % (len(unique_groups), k))
+
+        group_fold = np.empty(len(unique_groups), dtype=np.intp)
+        group_fold[rng.permutation(len(unique_groups))] = np.arange(len(unique_groups)) * k // len(unique_groups)
+        fold_of[:] = group_fold[group_ids]
+
+    # both sides keep the shuffled order of the permutation.
+    fold_of = fold_of[perm]
+    for i in range(k):
+        in_fold = fold_of == i
+        yield perm[~in_fold], perm[in_fold]
+
+
 def sum_2_dictionaries(d1, d2):
     """
     d1 and d2 are both {key: cnt} dictionaries. we want to sum them up such as:
@@ -149,7 +361,102 @@ def sum_2_2level_dicts_generic(d1, d2, defaultfunc, addfunc):
     return {x: sum_2_dictionaries_generic(d1.get(x, {}), d2.get(x, {}), defaultfunc, addfunc) for x in set(d1).union(d2)}
 
 
+def sum_dictionaries(dicts, acc=None):
+    """
+    The k-way version of sum_2_dictionaries, in one linear pass over all the keys:
+    sum_dictionaries([d1, d2, d3]) gives the same as reduce(sum_2_dictionaries, [d1, d2, d3]).
+    acc is the accumulator that is updated in place and returned, a new dictionary if it's None. So the partial
+    counters can also be folded in one by one: for d in partials: sum_dictionaries([d], acc)
+    """
+    if acc is None:
+        acc = {}
+
+    get = acc.get
+    for d in dicts:
+        for key, cnt in d.iteritems():
+            acc[key] = get(key, 0) + cnt
+
+    return acc
+
+
+def sum_2level_dicts(dicts, acc=None):
+    """
+    The k-way, in place version of sum_2_2level_dicts. See sum_dictionaries.
+    """
+    if acc is None:
+        acc = {}
+
+    for d in dicts:
+        for key, sub in d.iteritems():
+            sum_dictionaries((sub,), acc.setdefault(key, {}))
+
+    return acc
+
+
+def sum_dictionaries_generic(dicts, defaultfunc, addfunc, acc=None):
+    """
+    The k-way, in place version of sum_2_dictionaries_generic. See sum_dictionaries.
+    The values in acc are always created by defaultfunc (never taken from dicts), so addfunc can update its first
+    argument in place and return it, ex. addfunc=lambda x, y: x.__iadd__(y) for numpy arrays.
+    """
+    if acc is None:
+        acc = {}
+
+    for d in dicts:
+        for key, val in d.iteritems():
+            acc[key] = addfunc(acc[key] if key in acc else defaultfunc(), val)
+
+    return acc
+
+
+def sum_2level_dicts_generic(dicts, defaultfunc, addfunc, acc=None):
+    """
+    The k-way, in place version of sum_2_2level_dicts_generic. See sum_dictionaries_generic.
+    """
+    if acc is None:
+        acc = {}
+
+    for d in dicts:
+        for key, sub in d.iteritems():
+            sum_dictionaries_generic((sub,), defaultfunc, addfunc, acc.setdefault(key, {}))
+
+    return acc
+
+
+def sum_dictionaries_dense(dicts, size=None, dtype=None):
+    """
+    For {int key: cnt} dictionaries whose keys are small non negative integers (ids, buckets etc.), sum them up
+    into a numpy array where array[key] is the total count. The array grows if size is None or too small.
+    """
+    import numpy as np
+
+    dtype = np.int64 if dtype is None else dtype
+    length = size or 0
+    acc = np.zeros(length, dtype=dtype)
+
+    for d in dicts:
+        if not d:
+            continue
+
+        keys = np.fromiter(d.iterkeys(), dtype=np.int64, count=len(d))
+        cnts = np.fromiter(d.itervalues(), dtype=dtype, count=len(d))
+        if keys.min() < 0:
+            raise ValueError('The keys must be non negative integers, got %d.' % keys.min())
+
+        length = max(length, keys.max() + 1)
+        if length > len(acc):
+            acc = np.concatenate((acc, np.zeros(max(length, 2 * len(acc)) - len(acc), dtype=dtype)))
+
+        # the keys of one dictionary are unique, so += is fine with the fancy indexing.
+        acc[keys] += cnts
+
+    return acc[:length]
+
+
 def disp_tm_msg(msg):
+    """
+    Print a time stamped message. For the durations, counts and rates of a pipeline, see the timing module.
+    """
     print 'time [%s]: %s' % (datetime.now(), msg)
     sys.stdout.flush()
 
@@ -5,11 +5,25 @@ for volume estimation etc.
 I plan to rename this module to a different name and keep both version to avoid the rewriting of the modules that
 are dependent on the first version of variables.
 """
+from contextlib import contextmanager
+from cStringIO import StringIO
+from multiprocessing import Pool
 import numpy as np
+import cPickle
 import pickle
 import json
 import copy
-from .tools import cv_k_fold
+import functools
+import hashlib
+import mmap
+import os
+import re
+import shutil
+import struct
+import tempfile
+import types
+from .fileio import open_writer
+from .tools import array_chunker, chunker, k_fold_indices, prefetch
 
 
 class Variable(object):
@@ -48,22 +62,32 @@ class Variable(object):
         return 'name: %s, normalization: %s, mean_std: %s, description: %s' % \
                (self.name, self.normalization, self.mean_std, self.description)
 
+    def get_parameters(self):
+        """
+        The parameters to serialize as a dictionary. We only need to serialize the parameters that are not known
+        at the time when the variable is created. And we cannot (easily and cleanly) serialize the transforms anyway.
+        """
+        return {'normalization': self.normalization, 'mean_std': self.mean_std}
+
+    def set_parameters(self, parameters):
+        """
+        The opposite of get_parameters.
+        """
+        self.normalization = parameters['normalization']
+        self.mean_std = parameters['mean_std']
+
     def dump_parameters(self):
         """
-        used for serialization. We only need to serialize the parameters that are not known at the time when the
-        variable is created. And we cannot (easily and cleanly) serialize the transforms anyway.
+        used for serialization. See get_parameters.
         based on json.
         """
-        return json.dumps({'normalization': self.normalization, 'mean_std': self.mean_std})
+        return json.dumps(self.get_parameters())
 
     def load_parameters(self, var_json_str):
         """
         load the serialized variable and return an object.
         """
-        json_obj = json.loads(var_json_str)
-
-        self.normalization = json_obj['normalization']
-        self.mean_std = json_obj['mean_std']
+        self.set_parameters(json.loads(var_json_str))
 
 
 class ModelVariables(object):
@@ -104,18 +128,29 @@ class ModelVariables(object):
         """
         return delimiter.join(str(variable.pre_transform(input_data)) for variable in self.schema)
 
+    def _data_str_func(self, delimiter='\t'):
+        """
+        data_str compiled into one function (see fuse_functions), for writing many items.
+        """
+        join = delimiter.join
+        pre_transforms = fuse_functions([variable.pre_transform for variable in self.schema], wrapper='str')
+
+        return lambda input_data: join(pre_transforms(input_data))
+
     def write_training_data(self, data, output, header=False, delimiter='\t'):
         """
         If given an iterator of training data source data set, we can use this method to write all the data out
         to a file.
         """
-        with open(output, 'w') as fout:
+        data_str = self._data_str_func(delimiter)
+
+        with open_writer(output) as fout:
             if header:
                 fout.write(delimiter.join(variable.name for variable in self.schema))
                 fout.write('\n')
 
             for item in data:
-                fout.write('%s\n', self.data_str(item, delimiter))
+                fout.write('%s\n' % data_str(item))
 
     def dump_parameters(self):
         """
@@ -129,6 +164,25 @@ class ModelVariables(object):
                            'dependent': dump_variables(self.dependent),
                            'schema': dump_variables(self.schema)})
 
+    def get_parameters(self):
+        """
+        The parameters of all the variables as a dictionary of lists, without the json strings in json strings of
+        dump_parameters. Used by the binary model files.
+        """
+        return {'independent': [variable.get_parameters() for variable in self.independent],
+                'dependent': [variable.get_parameters() for variable in self.dependent],
+                'schema': [variable.get_parameters() for variable in self.schema]}
+
+    def set_parameters(self, parameters):
+        """
+        The opposite of get_parameters.
+        """
+        for variables, key in ((self.independent, 'independent'), (self.dependent, 'dependent'),
+                               (self.schema, 'schema')):
+            assert len(variables) == len(parameters[key])
+            for variable, variable_parameters in zip(variables, parameters[key]):
+                variable.set_parameters(variable_parameters)
+
     def load_parameters(self, var_json_str):
         """
         load the serialized variable parameters for normalization.
@@ -144,12 +198,53 @@ class ModelVariables(object):
         loads_variables(self.dependent, json_obj['dependent'])
         loads_variables(self.schema, json_obj['schema'])
 
-    def get_training_data(self, fname, delimiter='\t', header=True):
+    def get_training_data(self, fname, delimiter='\t', header=True, columnar=False, dtype=np.float64,
+                          batch_size=10000, cache=None):
         """
         read data from fname, and returns a X, y. No normalization done here.
+
+        columnar=True loads the data straight into a typed numpy buffer (dtype, e.g. np.float64 or np.float32)
+        batch_size rows at a time, instead of building a python list of rows first. Much smaller peak memory for
+        big files. All the transforms must return numbers in this case.
+
+        cache: a TrainingDataCache. The parsed X, y are kept there, and loaded back (memory mapped) the next time
+        the same file is read with the same variable definitions. It's not used (with a warning) when a transform
+        uses values that can not be fingerprinted, see TrainingDataCache.key.
+        """
+        key = None
+        if cache is not None:
+            key = cache.key(self, fname, delimiter=delimiter, header=header, columnar=columnar,
+                            dtype=np.dtype(dtype).str)
+
+        if key is not None:
+            cached = cache.load(key)
+            if cached is not None:
+                return cached
+
+            X, y = self.get_training_data(fname, delimiter=delimiter, header=header, columnar=columnar, dtype=dtype,
+                                          batch_size=batch_size)
+            cache.store(key, X, y)
+            return X, y
+
+        if columnar:
+            data = self._read_from_tsv_columnar(fname, header=header, delimiter=delimiter, dtype=dtype,
+                                                batch_size=batch_size)
+        else:
+            data = self._read_from_tsv(fname, header=header, delimiter=delimiter)
+
+        return self._split_X_y(data)
+
+    def iter_training_chunks(self, fname, delimiter='\t', header=True, dtype=np.float64, chunk_size=10000):
         """
-        data = self._read_from_tsv(fname, header=header, delimiter=delimiter)
+        The streaming version of get_training_data. It yields (X, y) of at most chunk_size rows at a time, so the
+        memory does not depend on the file size.
+        Note: the chunks are views of one buffer that is reused, copy them if they have to be kept.
+        """
+        for data in self._iter_tsv_arrays(fname, header=header, delimiter=delimiter, dtype=dtype,
+                                          batch_size=chunk_size):
+            yield self._split_X_y(data)
 
+    def _split_X_y(self, data):
         dependent_dim = len(self.dependent)
 
         X = data[:, dependent_dim:]
@@ -181,6 +276,43 @@ class ModelVariables(object):
 
         return np.array(data)
 
+    def _read_from_tsv_columnar(self, fname, header=True, delimiter='\t', dtype=np.float64, batch_size=10000):
+        """
+        Same as _read_from_tsv, but the rows are put into a preallocated numpy buffer in batches. The buffer
+        doubles when it is full and gets trimmed to the real row count at the end.
+        :return: data in the form of a 2-d numpy array of dtype.
+        """
+        column_cnt = len(self.dependent) + len(self.independent)
+
+        data = np.empty((batch_size, column_cnt), dtype=dtype)
+        row_cnt = 0
+
+        for batch in self._iter_tsv_arrays(fname, header=header, delimiter=delimiter, dtype=dtype,
+                                           batch_size=batch_size):
+            if row_cnt + len(batch) > data.shape[0]:
+                data.resize((2 * data.shape[0], column_cnt), refcheck=False)
+
+            data[row_cnt: row_cnt + len(batch)] = batch
+            row_cnt += len(batch)
+
+        data.resize((row_cnt, column_cnt), refcheck=False)
+        return data
+
+    def _iter_tsv_arrays(self, fname, header=True, delimiter='\t', dtype=np.float64, batch_size=10000):
+        """
+        Read the tsv file batch_size rows at a time. Each batch is mapped into (a view of) the same numpy buffer.
+        """
+        mapping = self._mapping_input_line_2_numbers()
+
+        with open(fname) as fin:
+            if header:
+                fin.readline()
+
+            rows = (mapping(line.strip().split(delimiter)) for line in fin)
+            for batch in array_chunker(batch_size, (row for row in rows if row is not None),
+                                       width=len(self.dependent) + len(self.independent), dtype=dtype):
+                yield batch
+
     def _mapping_input_line_2_numbers(self):
         """
         Create a function that takes a splitted line of the training data file as the input.
@@ -189,15 +321,251 @@ class ModelVariables(object):
         Note: this function is to create all the independent and dependent variables used in machine learning
         model training step.
         """
-        def func(splitted):
-            """
-            :param splitted: a line of the training data that got splitted.
-            :return: a list of feature variables.
-            """
-            # We first create dependent variables and then we create independent variables.
-            return [item.transform(splitted) for item in self.dependent + self.independent]
+        # We first create dependent variables and then we create independent variables.
+        # The input is a line of the training data that got splitted, the output is a list of feature variables.
+        return fuse_functions([item.transform for item in self.dependent + self.independent])
+
+
+class SharedStep(object):
+    """
+    A step shared by several transforms of the same row, ex. parsing a time stamp or a url that many variables
+    use. It's computed once for each row (remembered by the identity of the row object):
+        parsed_time = SharedStep(lambda x: parse_time(x[3]))
+        hour = Variable('hour', transform=lambda x: parsed_time(x).hour)
+        weekday = Variable('weekday', transform=lambda x: parsed_time(x).weekday())
+    The row object must not be changed in place between two rows.
+    """
+    __slots__ = ('func', '_row', '_value')
+
+    def __init__(self, func):
+        self.func = func
+        self._row = None
+        self._value = None
+
+    def __call__(self, row):
+        if row is not self._row:
+            # keep the row itself, so its id can not be reused by the next one.
+            self._value = self.func(row)
+            self._row = row
+
+        return self._value
+
+    def __repr__(self):
+        return 'SharedStep(%r)' % (self.func,)
+
+
+def fuse_functions(funcs, wrapper=None):
+    """
+    Compile a list of functions of the same input into one function returning the list of their results, ex.
+    fuse_functions([f0, f1]) is lambda row: [f0(row), f1(row)] without a python loop. wrapper (ex. 'str') is the
+    name of a builtin applied to each result.
+    """
+    namespace = dict(('f%d' % index, func) for index, func in enumerate(funcs))
+    call = '%s(f%%d(row))' % wrapper if wrapper else 'f%d(row)'
+
+    exec 'def fused(row):\n    return [%s]\n' % ', '.join(call % index for index in xrange(len(funcs))) in namespace
+    return namespace['fused']
+
+
+class TrainingDataCache(object):
+    """
+    A directory of parsed training data (see ModelVariables.get_training_data) as .npy files, so the same tsv file
+    does not need to be parsed again for every experiment.
+
+    The key is made of the file's path, size and mtime, the reading options, and a fingerprint of the dependent and
+    independent variables (names, and the code and values the transforms use, see _function_fingerprint). The files
+    are written to temp names and renamed, and loaded with mmap_mode='c', so several processes can use the same
+    cache. When max_bytes is set, the least recently used entries are removed to keep the directory under it.
+    """
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # another process made it.
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def key(self, model_variables, fname, **read_args):
+        """
+        The cache key, or None if a transform can not be fingerprinted (see _function_fingerprint), then the data
+        must not be cached.
+        """
+        stat = os.stat(fname)
+        sha = hashlib.sha1(repr((os.path.abspath(fname), stat.st_size, stat.st_mtime, sorted(read_args.items()))))
+
+        for variable in model_variables.dependent + model_variables.independent:
+            sha.update(repr(variable.name))
+            try:
+                sha.update(_function_fingerprint(variable.transform))
+            except ValueError as e:
+                print 'Warning. the training data is not cached, %s: %s' % (variable.name, e)
+                return None
+
+        return sha.hexdigest()
+
+    def _paths(self, key):
+        return os.path.join(self.cache_dir, key + '.X.npy'), os.path.join(self.cache_dir, key + '.y.npy')
+
+    def load(self, key):
+        """
+        (X, y) or None if it's not in the cache.
+        """
+        x_path, y_path = self._paths(key)
+        try:
+            X = np.load(x_path, mmap_mode='c')
+            y = np.load(y_path, mmap_mode='c')
+            # the mtime is the last use time for the eviction.
+            os.utime(x_path, None)
+        except (IOError, OSError):
+            return None
+
+        return X, y
+
+    def store(self, key, X, y):
+        # y first and X last, so load does not find an X without its y.
+        for path, arr in reversed(zip(self._paths(key), (X, y))):
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fout:
+                np.save(fout, arr)
+            os.rename(tmp_path, path)
+
+        self.evict()
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+
+        entries = {}
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npy'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+
+            key = name.split('.', 1)[0]
+            last_used, size = entries.get(key, (0, 0))
+            entries[key] = (max(last_used, stat.st_mtime), size + stat.st_size)
+
+        total = sum(size for _, size in entries.itervalues())
+        for key, (_, size) in sorted(entries.iteritems(), key=lambda entry: entry[1][0]):
+            if total <= self.max_bytes:
+                break
+
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+
+def _function_fingerprint(func):
+    """
+    A string that only depends on what func computes: the byte code, constants and default arguments of the
+    function, the values of its closure and of the globals it uses, and the same (recursively) for the functions
+    among them. Nothing in it depends on memory addresses, so it's the same in every run.
+    It raises ValueError for a value it can not fingerprint, ex. an instance of a class of our own.
+    """
+    return repr(_fingerprint(func, set()))
+
+
+_STABLE_TYPES = (type(None), bool, int, long, float, complex, str, unicode)
+_REGEX_TYPE = type(re.compile(''))
+
+
+def _fingerprint(value, seen):
+    if isinstance(value, _STABLE_TYPES):
+        return value
+
+    if isinstance(value, (tuple, list)):
+        return type(value).__name__, tuple(_fingerprint(item, seen) for item in value)
+
+    if isinstance(value, (set, frozenset)):
+        return type(value).__name__, tuple(sorted(repr(_fingerprint(item, seen)) for item in value))
 
-        return func
+    if isinstance(value, dict):
+        return 'dict', tuple(sorted((repr(_fingerprint(key, seen)), _fingerprint(item, seen))
+                                    for key, item in value.iteritems()))
+
+    if isinstance(value, types.FunctionType):
+        if id(value) in seen:
+            # a recursive call, its code is already in the fingerprint.
+            return 'function', value.__module__, value.__name__
+        seen.add(id(value))
+
+        global_names = sorted(name for name in _code_names(value.__code__) if name in value.__globals__)
+        return ('function', _fingerprint(value.__code__, seen), _fingerprint(value.__defaults__, seen),
+                tuple(_fingerprint(cell.cell_contents, seen) for cell in value.__closure__ or ()),
+                tuple((name, _fingerprint(value.__globals__[name], seen)) for name in global_names))
+
+    if isinstance(value, types.CodeType):
+        return 'code', value.co_code, value.co_argcount, value.co_names, _fingerprint(value.co_consts, seen)
+
+    if isinstance(value, SharedStep):
+        return 'SharedStep', _fingerprint(value.func, seen)
+
+    if isinstance(value, functools.partial):
+        return 'partial', _fingerprint(value.func, seen), _fingerprint(value.args, seen), \
+            _fingerprint(value.keywords or {}, seen)
+
+    if isinstance(value, types.MethodType):
+        return 'method', _fingerprint(value.im_func, seen), _fingerprint(value.im_self, seen)
+
+    if isinstance(value, (staticmethod, classmethod)):
+        return type(value).__name__, _fingerprint(value.__func__, seen)
+
+    if isinstance(value, (type, types.ClassType)):
+        if id(value) in seen:
+            return 'class', value.__module__, value.__name__
+        seen.add(id(value))
+
+        methods = sorted((name, _fingerprint(item, seen)) for name, item in vars(value).iteritems()
+                         if isinstance(item, (types.FunctionType, staticmethod, classmethod)))
+        return 'class', value.__module__, value.__name__, tuple(methods)
+
+    if isinstance(value, types.BuiltinFunctionType):
+        owner = value.__self__
+        owner = None if owner is None or isinstance(owner, types.ModuleType) else _fingerprint(owner, seen)
+        return 'builtin', getattr(value, '__module__', None), value.__name__, owner
+
+    if isinstance(value, types.ModuleType):
+        return 'module', value.__name__
+
+    if isinstance(value, np.ufunc):
+        return 'ufunc', value.__name__
+
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        return 'ndarray', value.dtype.str, value.shape, hashlib.sha1(np.ascontiguousarray(value).tostring()).hexdigest()
+
+    if isinstance(value, _REGEX_TYPE):
+        return 'regex', value.pattern, value.flags
+
+    raise ValueError('Can not fingerprint a %s.' % type(value).__name__)
+
+
+def _code_names(code):
+    """
+    The global (or attribute) names used by code and the functions defined in it.
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(_code_names(const))
+
+    return names
+
+
+_MODEL_FILE_MAGIC = 'FENGPYMD'
+_MODEL_FILE_VERSION = 1
+# magic, version, index offset, index length.
+_MODEL_FILE_HEADER = struct.Struct('<8sIQQ')
+_MODEL_FILE_ALIGNMENT = 64
 
 
 class ModelDriver(object):
@@ -212,16 +580,23 @@ class ModelDriver(object):
     The major goal is to make the normalization parameters as an output of the training process, and an
     input of the prediction process.
     """
-    def __init__(self, variable_def=None, model=None):
+    def __init__(self, variable_def=None, model=None, dtype=None):
         """
         The model must be a sklearn model or any models that has fit() and predict() as well as picklable.
         :param variable_def: an object of ModelVariables that contains the variable definition and normalization
                              parameters.
         :param model: the sklearn model that defined outside. It will be trained here.
+        :param dtype: the float type the model is trained and predicted on, ex. np.float32 to halve the memory.
+                      None means np.float64 (unless the predictors are float32 already).
 
         """
         self.variable_def = variable_def
         self.model = model
+        self.dtype = dtype
+        # fit(reuse_buffer=True) writes the normalized training data here, and reuses it for the next fit (k-fold cv).
+        self._fit_buffer = None
+        # compile_normalization's vectors, cleared wherever mean_std is set.
+        self._normalization = None
 
     def serialize_model_parameters(self):
         """
@@ -240,32 +615,205 @@ class ModelDriver(object):
         json_obj = json.loads(model_json_str)
         self.variable_def.load_parameters(json_obj['variable_def'])
         self.model = pickle.loads(json_obj['model'])
+        self._normalization = None
+
+    def save_model_file(self, filename, min_array_bytes=1024):
+        """
+        Save the model and the normalization parameters into a binary file. Much smaller and faster to load than
+        serialize_model_parameters for big models.
+
+        The model is pickled with the highest protocol, but the numpy arrays of at least min_array_bytes are taken
+        out of the pickle and written raw (64 bytes aligned), so load_model_file can memory map them. The layout is:
+            header: magic, format version, offset and length of the index
+            the raw arrays
+            index: a pickled dictionary of the variable parameters, the arrays' (offset, dtype, shape, order)
+                   and the model pickle.
+        """
+        arrays = []
+        # id -> index in arrays, so an array the model refers to more than once is written once and loads back
+        # as one array. The arrays list keeps them alive, so the ids are not reused.
+        array_ids = {}
+
+        def persistent_id(obj):
+            if type(obj) is np.ndarray and not obj.dtype.hasobject and obj.nbytes >= min_array_bytes:
+                if id(obj) not in array_ids:
+                    array_ids[id(obj)] = len(arrays)
+                    arrays.append(obj)
+                return array_ids[id(obj)]
+            return None
+
+        model_buf = StringIO()
+        pickler = cPickle.Pickler(model_buf, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump(self.model)
+
+        with open(filename, 'wb') as fout:
+            fout.write(_MODEL_FILE_HEADER.pack(_MODEL_FILE_MAGIC, _MODEL_FILE_VERSION, 0, 0))
+
+            array_table = []
+            for arr in arrays:
+                fout.write('\0' * (-fout.tell() % _MODEL_FILE_ALIGNMENT))
+                fortran = arr.flags.f_contiguous and not arr.flags.c_contiguous
+                array_table.append((fout.tell(), arr.dtype, arr.shape, 'F' if fortran else 'C'))
+                fout.write(arr.tobytes(order='F' if fortran else 'C'))
+
+            index = cPickle.dumps({'variable_def': self.variable_def.get_parameters(),
+                                   'arrays': array_table,
+                                   'model': model_buf.getvalue()}, cPickle.HIGHEST_PROTOCOL)
+            index_offset = fout.tell()
+            fout.write(index)
+
+            fout.seek(0)
+            fout.write(_MODEL_FILE_HEADER.pack(_MODEL_FILE_MAGIC, _MODEL_FILE_VERSION, index_offset, len(index)))
+
+    def load_model_file(self, filename, use_mmap=True):
+        """
+        Load a file written by save_model_file. With use_mmap the model's arrays are copy-on-write views of the
+        memory mapped file instead of copies. Load it once in the parent process before forking the prediction
+        workers, so they all share the same pages.
+        """
+        with open(filename, 'rb') as fin:
+            magic, version, index_offset, index_len = _MODEL_FILE_HEADER.unpack(fin.read(_MODEL_FILE_HEADER.size))
+            if magic != _MODEL_FILE_MAGIC:
+                raise ValueError('%s is not a model file.' % filename)
+            if version > _MODEL_FILE_VERSION:
+                raise ValueError('Unsupported model file version %d in %s.' % (version, filename))
+
+            if use_mmap:
+                data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_COPY)
+            else:
+                fin.seek(0)
+                data = bytearray(fin.read())
+
+        index = cPickle.loads(str(data[index_offset: index_offset + index_len]))
+        arrays = [np.ndarray(shape, dtype=dtype, buffer=data, offset=offset, order=order)
+                  for offset, dtype, shape, order in index['arrays']]
+
+        unpickler = cPickle.Unpickler(StringIO(index['model']))
+        unpickler.persistent_load = arrays.__getitem__
+
+        self.variable_def.set_parameters(index['variable_def'])
+        self.model = unpickler.load()
+        self._normalization = None
+
+    def compile_normalization(self):
+        """
+        Turn the normalization settings of the independent variables into vectors. They are compiled once and kept
+        until the normalization parameters are set again (fit, fit_from_tsv, load_model_parameters, load_model_file).
+        Call reset_normalization() after changing mean_std or variable_def by hand.
+        :return: mask (which columns are normalized), mean and scale. mean is 0 and scale is 1 for the columns that
+                 are not normalized, so (X - mean) / scale can be done on the whole matrix.
+        """
+        if self._normalization is not None:
+            return self._normalization
+
+        independent = self.variable_def.independent
 
-    def normalize(self, X, calculate_mean_std=True):
+        mask = np.array([item.normalization for item in independent], dtype=bool)
+        mean = np.zeros(len(independent))
+        scale = np.ones(len(independent))
+
+        for index, item in enumerate(independent):
+            if item.normalization:
+                mean[index], scale[index] = item.mean_std
+
+        self._normalization = mask, mean, scale
+        return self._normalization
+
+    def reset_normalization(self):
+        self._normalization = None
+
+    def normalize(self, X, calculate_mean_std=True, out=None):
         """
         normalize data before the training and predicting.
         :param X:
-        :return:
+        :param out: where to write the normalized data. X is changed in place when it's None.
+        :return: the normalized data (out or X).
         """
-        for index, item in enumerate(self.variable_def.independent):
-            if item.normalization:
-                if calculate_mean_std:
-                    m = np.mean(X[:, index])
-                    s = np.std(X[:, index])
-                    item.mean_std = [m, s]
+        if out is None:
+            out = X
+
+        if calculate_mean_std:
+            independent = self.variable_def.independent
+            normalized = [index for index, item in enumerate(independent) if item.normalization]
+            if normalized:
+                # in row blocks, so the column selection and the temporaries of std are block sized, not X sized.
+                all_columns = len(normalized) == X.shape[1]
+                blocks = (X[start: start + _STATS_BLOCK_ROWS] if all_columns else
+                          X[start: start + _STATS_BLOCK_ROWS, normalized]
+                          for start in xrange(0, X.shape[0], _STATS_BLOCK_ROWS))
+                for index, m, s in zip(normalized, *_streaming_mean_std(blocks)):
+                    independent[index].mean_std = [float(m), float(s)]
+            self._normalization = None
+
+        mask, mean, scale = self.compile_normalization()
+
+        if mask.any():
+            np.subtract(X, mean, out=out)
+            np.divide(out, scale, out=out)
+        elif out is not X:
+            out[...] = X
+
+        return out
+
+    def fit_from_tsv(self, fname, delimiter='\t', header=True, chunk_size=10000, prefetch_chunks=0,
+                     **partial_fit_args):
+        """
+        Out of core training from a training data file (see ModelVariables.get_training_data). The model must have
+        partial_fit(). partial_fit_args go to each partial_fit call, ex. classes=[0, 1] for classifiers.
 
-                X[:, index] = (X[:, index] - item.mean_std[0]) / item.mean_std[1]
+        The first pass over the file gets the normalization parameters chunk by chunk; the second pass normalizes
+        every chunk and feeds it to partial_fit. The memory is bounded by chunk_size whatever the file size is.
 
-    def fit(self, predictors, y):
+        With prefetch_chunks > 0, the file is parsed in a forked process (see tools.prefetch), up to
+        prefetch_chunks chunks ahead of partial_fit.
+        """
+        dtype = self._float_dtype()
+        variable_def = self.variable_def
+        independent = variable_def.independent
+
+        normalized = [index for index, item in enumerate(independent) if item.normalization]
+        if normalized:
+            chunks = (X[:, normalized] for X, _ in variable_def.iter_training_chunks(
+                fname, delimiter=delimiter, header=header, dtype=dtype, chunk_size=chunk_size))
+            for index, m, s in zip(normalized, *_streaming_mean_std(chunks)):
+                independent[index].mean_std = [float(m), float(s)]
+        self._normalization = None
+
+        chunks = variable_def.iter_training_chunks(fname, delimiter=delimiter, header=header, dtype=dtype,
+                                                   chunk_size=chunk_size)
+        if prefetch_chunks > 0:
+            chunks = prefetch(chunks, buffer_size=prefetch_chunks, chunk_size=1, use_process=True)
+
+        for X, y in chunks:
+            self.normalize(X, calculate_mean_std=False)
+            self.model.partial_fit(X, y, **partial_fit_args)
+
+    def _float_dtype(self, X=None):
+        if self.dtype is not None:
+            return np.dtype(self.dtype)
+
+        return X.dtype if X is not None and X.dtype == np.float32 else np.dtype(np.float64)
+
+    def fit(self, predictors, y, reuse_buffer=False):
         """
         train the model using observations. Do normalization if needed.
         :param X: independent variables. 2-d numpy array.
         :param y: dependent variable. 1-d numpy array.
+        :param reuse_buffer: keep the normalized copy of the data for the next fit (k-fold cv), instead of freeing
+                             it when the fit is done.
         :return: Nothing.
         """
-        # we don't want to change the data in place, for cross-validation's reason.
-        X = np.copy(predictors)
-        self.normalize(X)
+        # we don't want to change the data in place, for cross-validation's reason. So the normalized data goes
+        # into a new buffer, or the one kept from the last fit if it's big enough.
+        dtype = self._float_dtype(predictors)
+        buf = self._fit_buffer if reuse_buffer else None
+        if buf is None or buf.dtype != dtype or buf.shape[1:] != predictors.shape[1:] or \
+                buf.shape[0] < predictors.shape[0]:
+            buf = np.empty(predictors.shape, dtype=dtype)
+        self._fit_buffer = buf if reuse_buffer else None
+
+        X = self.normalize(predictors, out=buf[:predictors.shape[0]])
 
         self.model.fit(X, y)
 
@@ -276,9 +824,10 @@ class ModelDriver(object):
         make_copy controls the data change in place.
         """
         if make_copy:
-            predictors = np.copy(predictors)
-
-        self.normalize(predictors, calculate_mean_std=False)
+            predictors = self.normalize(predictors, calculate_mean_std=False,
+                                        out=np.empty(predictors.shape, dtype=self._float_dtype(predictors)))
+        else:
+            self.normalize(predictors, calculate_mean_std=False)
 
         if predict_prob:
             return self.model.predict_proba(predictors)
@@ -291,12 +840,76 @@ class ModelDriver(object):
         And then feed this numpy array to predict method.
         """
         X_lst = [variable.post_transform(item) for variable in self.variable_def.independent]
-        X = np.array(X_lst).reshape((1, -1))
+        X = np.array(X_lst, dtype=self._float_dtype()).reshape((1, -1))
 
         return self.predict(X, make_copy=False, predict_prob=predict_prob)
 
+    def iter_predict_items(self, items, predict_prob=False, batch_size=10000):
+        """
+        The batch version of item_predict. items is an iterable of raw items (same as the input of item_predict).
+        It yields one array of predictions for every batch_size items. Each batch goes through the post-transforms
+        into one preallocated matrix (reused for all the batches), gets normalized once and predicted with one call.
+        """
+        independent = self.variable_def.independent
+        X = np.empty((batch_size, len(independent)), dtype=self._float_dtype())
+
+        for batch in chunker(batch_size, items):
+            batch_X = X[:len(batch)]
+            for index, variable in enumerate(independent):
+                batch_X[:, index] = [variable.post_transform(item) for item in batch]
+
+            yield self.predict(batch_X, make_copy=False, predict_prob=predict_prob)
+
+    def predict_items(self, items, predict_prob=False, batch_size=None):
+        """
+        Predict a list (or any iterable) of raw items together. See iter_predict_items. Without batch_size, all
+        the items are done in one batch.
+        :return: the predictions of all the items, in one numpy array.
+        """
+        if batch_size is None:
+            items = list(items)
+            batch_size = max(len(items), 1)
+
+        predicted = list(self.iter_predict_items(items, predict_prob=predict_prob, batch_size=batch_size))
+        if not predicted:
+            return np.array([])
+
+        return predicted[0] if len(predicted) == 1 else np.concatenate(predicted)
 
-def k_fold_train_test_model(model, X, y, perf_measure, variable_def, k_fold=5):
+
+# the row block size of the mean and std in ModelDriver.normalize.
+_STATS_BLOCK_ROWS = 65536
+
+
+def _streaming_mean_std(chunks):
+    """
+    Column means and (population) standard deviations of a stream of 2-d arrays, merged chunk by chunk in
+    float64 with Chan's parallel algorithm, so it's as stable as computing them on the whole data at once.
+    """
+    cnt, mean, m2 = 0, 0.0, 0.0
+
+    for chunk in chunks:
+        chunk_cnt = chunk.shape[0]
+        if chunk_cnt == 0:
+            continue
+
+        chunk_mean = chunk.mean(axis=0, dtype=np.float64)
+        chunk_m2 = np.square(chunk - chunk_mean).sum(axis=0)
+
+        total = cnt + chunk_cnt
+        delta = chunk_mean - mean
+        mean = mean + delta * chunk_cnt / total
+        m2 = m2 + chunk_m2 + np.square(delta) * cnt * chunk_cnt / total
+        cnt = total
+
+    if cnt == 0:
+        raise ValueError('No data to get the mean and std from.')
+
+    return mean, np.sqrt(m2 / cnt)
+
+
+def k_fold_train_test_model(model, X, y, perf_measure, variable_def, k_fold=5, n_jobs=None, seed=None,
+                            stratify=False, groups=None):
     """
     running k-fold on a model and data set.
     :param model:
@@ -305,25 +918,33 @@ def k_fold_train_test_model(model, X, y, perf_measure, variable_def, k_fold=5):
     :param perf_measure: A functions used to measure the performance of each of k-fold run. Its parameters are
                          the observed dependent variable and the predicted.
     :param k_fold:
+    :param n_jobs: run the folds in this many processes (-1 for all the cpus). See _run_folds.
+    :param seed: the random seed of the folds, see tools.k_fold_indices. random.seed() has no effect on the folds
+                 (it did when they came from cv_k_fold), so pass a seed to get the same folds again.
+    :param stratify: stratify the folds by y (for classifiers).
+    :param groups: keep the rows of every group in one fold.
     :return: the average of performance result for all the folds.
     """
-    estimator = ModelDriver(copy.deepcopy(variable_def), model=model)
+    _check_n_jobs(n_jobs)
+    folds = list(k_fold_indices(len(y), k_fold, seed=seed, labels=y if stratify else None, groups=groups))
 
-    def run_one_fold(train_indices, test_indices):
-        estimator.fit(X[train_indices, :], y[train_indices])
-        predicted = estimator.predict(X[test_indices])
-        observed = y[test_indices]
+    with _shared_arrays(X, y, n_jobs) as (X, y):
+        estimator = ModelDriver(copy.deepcopy(variable_def), model=model)
 
-        return perf_measure(observed, predicted)
+        def run_one_fold(train_indices, test_indices):
+            estimator.fit(X[train_indices, :], y[train_indices], reuse_buffer=True)
+            predicted = estimator.predict(X[test_indices])
+            observed = y[test_indices]
 
-    folds = cv_k_fold(len(y), k_fold)
+            return perf_measure(observed, predicted)
 
-    perf_list = [run_one_fold(fold[0], fold[1]) for fold in folds]
+        perf_list = _run_folds(run_one_fold, folds, n_jobs)
 
     return np.mean(perf_list)
 
 
-def k_fold_train_test_simple_model(model, X, y, perf_measure, k_fold=5):
+def k_fold_train_test_simple_model(model, X, y, perf_measure, k_fold=5, n_jobs=None, seed=None, stratify=False,
+                                   groups=None):
     """
     running k-fold on a model and data set. The model is not based on Variables, but a simple sklearn model.
     :param model:
@@ -332,18 +953,82 @@ def k_fold_train_test_simple_model(model, X, y, perf_measure, k_fold=5):
     :param perf_measure: A functions used to measure the performance of each of k-fold run. Its parameters are
                          the observed dependent variable and the predicted.
     :param k_fold:
+    :param n_jobs: run the folds in this many processes (-1 for all the cpus). See _run_folds.
+    :param seed: the random seed of the folds, see tools.k_fold_indices. random.seed() has no effect on the folds
+                 (it did when they came from cv_k_fold), so pass a seed to get the same folds again.
+    :param stratify: stratify the folds by y (for classifiers).
+    :param groups: keep the rows of every group in one fold.
     :return: the average of performance result for all the folds.
     """
+    _check_n_jobs(n_jobs)
+    folds = list(k_fold_indices(len(y), k_fold, seed=seed, labels=y if stratify else None, groups=groups))
 
-    def run_one_fold(train_indices, test_indices):
-        model.fit(X[train_indices, :],  y[train_indices])
-        predicted = model.predict(X[test_indices])
-        observed = y[test_indices]
-
-        return perf_measure(observed, predicted)
+    with _shared_arrays(X, y, n_jobs) as (X, y):
+        def run_one_fold(train_indices, test_indices):
+            model.fit(X[train_indices, :],  y[train_indices])
+            predicted = model.predict(X[test_indices])
+            observed = y[test_indices]
 
-    folds = cv_k_fold(len(y), k_fold)
+            return perf_measure(observed, predicted)
 
-    perf_list = [run_one_fold(fold[0], fold[1]) for fold in folds]
+        perf_list = _run_folds(run_one_fold, folds, n_jobs)
 
     return np.mean(perf_list)
+
+
+# The fold function of the running _run_folds. The forked workers inherit it, so the model, the closure and the
+# perf_measure never need to be picklable.
+_fold_runner = None
+
+
+def _run_fold(fold):
+    return _fold_runner(fold[0], fold[1])
+
+
+def _check_n_jobs(n_jobs):
+    if n_jobs is not None and (n_jobs == 0 or n_jobs != int(n_jobs)):
+        raise ValueError('n_jobs must be None, a positive number or negative (all the cpus), not %r.' % (n_jobs,))
+
+
+def _run_folds(run_one_fold, folds, n_jobs):
+    """
+    Run run_one_fold on all the folds, serially when n_jobs is None or 1, otherwise in a forked process pool.
+    The folds are created in the parent, so the results are the same as the serial ones for a fixed random seed.
+    Every worker fits its own copy of the model.
+    """
+    global _fold_runner
+
+    if n_jobs is None or n_jobs == 1:
+        return [run_one_fold(train_indices, test_indices) for train_indices, test_indices in folds]
+
+    _fold_runner = run_one_fold
+    pool = Pool(None if n_jobs < 0 else min(n_jobs, len(folds)))
+    try:
+        return pool.map(_run_fold, folds, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+        _fold_runner = None
+
+
+@contextmanager
+def _shared_arrays(X, y, n_jobs):
+    """
+    For the parallel k-fold, put X and y into memory mapped .npy files, so all the workers read the same pages
+    instead of getting their own copies. Nothing is done for the serial runs.
+    """
+    if n_jobs is None or n_jobs == 1:
+        yield X, y
+        return
+
+    tmp_dir = tempfile.mkdtemp(prefix='fengpy_kfold_')
+    try:
+        shared = []
+        for name, arr in (('X', X), ('y', y)):
+            fname = os.path.join(tmp_dir, name + '.npy')
+            np.save(fname, arr)
+            shared.append(np.load(fname, mmap_mode='r'))
+
+        yield tuple(shared)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,113 @@
+import bz2
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from fengpy import fileio
+
+
+class FailingFile(object):
+    """
+    A file whose second write fails.
+    """
+    def __init__(self):
+        self.writes = []
+
+    def write(self, buf):
+        if self.writes:
+            raise IOError('disk full')
+        self.writes.append(buf)
+
+    def close(self):
+        pass
+
+
+class TestCompressionOf(unittest.TestCase):
+    """
+    Test cases for sniffing the compression of a file without an extension.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_bz2_1(self):
+        """
+        A text file that starts with BZh is not bz2, the real ones (even empty) are.
+        """
+        fname = os.path.join(self.tmp_dir, 'data')
+        for content, expected in (('BZh_id\tvalue\n', None), (bz2.compress('a\tb\n'), 'bz2'), (bz2.compress(''), 'bz2')):
+            with open(fname, 'wb') as fout:
+                fout.write(content)
+            self.assertEqual(fileio.compression_of(fname), expected)
+
+        with open(fname, 'wb') as fout:
+            fout.write('BZh_id\tvalue\n')
+        with fileio.open_file(fname) as fin:
+            self.assertEqual(list(fin), ['BZh_id\tvalue\n'])
+
+    def test_pipe_1(self):
+        """
+        A named pipe is read from its first line, nothing is taken off by the sniffing.
+        """
+        fifo = os.path.join(self.tmp_dir, 'pipe')
+        os.mkfifo(fifo)
+
+        def write():
+            with open(fifo, 'w') as fout:
+                fout.write('a\tb\n1\t2\n')
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            self.assertEqual(fileio.compression_of(fifo), None)
+            with fileio.open_file(fifo) as fin:
+                self.assertEqual(list(fin), ['a\tb\n', '1\t2\n'])
+        finally:
+            writer.join()
+
+
+class TestBackgroundWriter(unittest.TestCase):
+    """
+    Test cases for the background writer.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write_1(self):
+        """
+        All the lines are written in order, compressed or not.
+        """
+        lines = ['%d\n' % i for i in xrange(1000)]
+
+        for name in ('plain.txt', 'compressed.txt.gz'):
+            fname = os.path.join(self.tmp_dir, name)
+            with fileio.open_writer(fname, batch_lines=7, max_pending=1) as fout:
+                fout.writelines(lines)
+
+            for threaded in (False, True):
+                with fileio.open_file(fname, threaded=threaded) as fin:
+                    self.assertEqual(list(fin), lines)
+
+    def test_error_1(self):
+        """
+        An error of the writing thread is raised in the caller.
+        """
+        writer = fileio.BackgroundWriter(FailingFile(), batch_lines=1)
+
+        def write_all():
+            for i in xrange(100):
+                writer.write('%d\n' % i)
+            writer.close()
+
+        self.assertRaises(IOError, write_all)
+
+
+if __name__ == "__main__":
+    unittest.main()
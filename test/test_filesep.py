@@ -0,0 +1,104 @@
+from cStringIO import StringIO
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from fengpy import filesep
+
+
+class TestLineIndex(unittest.TestCase):
+    """
+    Test cases for the sidecar line index.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmp_dir, 'lines.txt')
+        with open(self.fname, 'w') as fout:
+            for i in xrange(1, 101):
+                fout.write('line %d\n' % i)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_offsets_1(self):
+        """
+        Every step-th line offset points to the start of that line.
+        """
+        step, offsets = filesep.load_line_index(self.fname, step=7)
+
+        self.assertEqual(len(offsets), 15)
+        with open(self.fname, 'rb') as fin:
+            for i, offset in enumerate(offsets):
+                fin.seek(offset)
+                self.assertEqual(fin.readline(), 'line %d\n' % (i * step + 1))
+
+    def test_rebuild_on_change_1(self):
+        """
+        The index is rebuilt after the file changes.
+        """
+        filesep.load_line_index(self.fname, step=10)
+        with open(self.fname, 'a') as fout:
+            fout.write('line 101\n')
+
+        step, offsets = filesep.load_line_index(self.fname, step=10)
+        self.assertEqual(len(offsets), 11)
+
+
+class TestGetLines(unittest.TestCase):
+    """
+    Test cases for get_lines with and without the index.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmp_dir, 'lines.txt')
+        with open(self.fname, 'w') as fout:
+            for i in xrange(1, 101):
+                fout.write('line %d\n' % i)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_lines(self, start, end, **args):
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            filesep.get_lines(self.fname, start, end, **args)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def check_ranges(self, ranges):
+        for start, end in ranges:
+            self.assertEqual(self.get_lines(start, end, use_index=True, index_step=7), self.get_lines(start, end))
+
+    def test_indexed_1(self):
+        """
+        The same lines with the index, for ranges over the index steps and up to the last line.
+        """
+        self.assertEqual(self.get_lines(6, 9, use_index=True, index_step=7), 'line 6\nline 7\nline 8\nline 9\n')
+        self.check_ranges([(1, 1), (7, 8), (8, 8), (14, 16), (20, 50), (99, 100), (100, 100), (95, 200), (0, 3)])
+        self.assertTrue(os.path.exists(self.fname + filesep.INDEX_SUFFIX))
+
+    def test_indexed_stale_1(self):
+        """
+        A file changed after its index was built gives the new lines.
+        """
+        self.check_ranges([(30, 40)])
+
+        with open(self.fname, 'w') as fout:
+            for i in xrange(1, 121):
+                fout.write('%d\n' % i)
+        os.utime(self.fname, (0, 1000))
+
+        self.assertEqual(self.get_lines(30, 31, use_index=True, index_step=7), '30\n31\n')
+        self.check_ranges([(30, 40), (115, 120)])
+
+    def test_indexed_empty_1(self):
+        open(self.fname, 'w').close()
+        self.assertEqual(self.get_lines(1, 5, use_index=True), '')
+        self.check_ranges([(1, 5)])
+
+
+if __name__ == "__main__":
+    unittest.main()
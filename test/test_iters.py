@@ -0,0 +1,400 @@
+from collections import Counter
+from itertools import chain, islice
+from multiprocessing import Pool
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from fengpy import fileio, iters, tools
+
+
+def _get_b(row):
+    return row['b']
+
+
+def _b_is_even(row):
+    return int(row['b']) % 4 == 0
+
+
+def _count_keys(shard_name):
+    return Counter(row['k'] for row in iters.tsv_2_dict_iterator(shard_name, names=['k', 'v'], has_header=False))
+
+
+class TestParallelReaders(unittest.TestCase):
+    """
+    Test cases for the parallel mode of the tsv readers.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmp_dir, 'data.tsv')
+        with open(self.fname, 'w') as fout:
+            fout.write('a\tb\tc\n')
+            for i in xrange(1000):
+                fout.write('%d\t%d\t%d\n' % (i, i * 2, i * 3))
+            fout.write('wrong\tline\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_dict_iterator_1(self):
+        """
+        The parallel dict reader returns the same rows in the same order.
+        """
+        serial = list(iters.tsv_2_dict_iterator(self.fname, use_header_as_schema=True))
+        parallel = list(iters.tsv_2_dict_iterator(self.fname, use_header_as_schema=True, processes=3, chunk_bytes=100))
+
+        self.assertEqual(len(serial), 1000)
+        self.assertEqual(serial, parallel)
+
+    def test_bounded_imap_1(self):
+        """
+        The tasks are only taken max_pending ahead of the caller, ordered or not.
+        """
+        taken = []
+
+        def tasks():
+            for i in xrange(100):
+                taken.append(i)
+                yield -i
+
+        pool = Pool(2)
+        try:
+            for ordered in (True, False):
+                del taken[:]
+                results = iters._bounded_imap(pool, abs, tasks(), 4, ordered=ordered)
+                first = results.next()
+                self.assertTrue(len(taken) <= 5)
+                all_results = [first] + list(results)
+                self.assertEqual(all_results if ordered else sorted(all_results), range(100))
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def test_tuple_iterator_map_1(self):
+        """
+        map_func runs on each row, and unordered results have the same content.
+        """
+        mapped = iters.tsv_2_dict_iterator(self.fname, names=['a', 'b', 'c'], processes=2, ordered=False,
+                                           map_func=_get_b, chunk_bytes=1000)
+        self.assertEqual(sorted(mapped, key=int), [str(i * 2) for i in xrange(1000)])
+
+        tuples = list(iters.tsv_2_tuple_iterator(self.fname, 3, has_header=True, processes=4, chunk_bytes=10))
+        self.assertEqual(tuples[10], ['10', '20', '30'])
+        self.assertEqual(len(tuples), 1000)
+
+    def test_view_iterator_1(self):
+        """
+        The views have the same fields as the tuple reader.
+        """
+        expected = list(iters.tsv_2_tuple_iterator(self.fname, 3, has_header=True))
+
+        rows = [list(row) if len(row) != 3 else (row[2], row[0], list(row))
+                for row in iters.tsv_2_view_iterator(self.fname, has_header=True)]
+        self.assertEqual(rows[:-1], [(row[2], row[0], row) for row in expected])
+        self.assertEqual(rows[-1], ['wrong', 'line'])
+
+        projected = list(iters.tsv_2_view_iterator(self.fname, has_header=True, columns=[1]))
+        self.assertEqual(projected[5], ('10',))
+
+        with open(self.fname, 'w') as fout:
+            fout.write('a\t\tc\r\nd')
+        self.assertEqual(list(iters.tsv_2_view_iterator(self.fname, columns=[0])), [('a',), ('d',)])
+        self.assertEqual(iters.tsv_2_view_iterator(self.fname, columns=[0, 1, 2]).next(), ('a', '', 'c'))
+        self.assertRaises(IndexError, list, iters.tsv_2_view_iterator(self.fname, columns=[1]))
+
+        # a delimiter of more than one character.
+        with open(self.fname, 'w') as fout:
+            fout.write('ab::cd::ef\n')
+        views = iters.tsv_2_view_iterator(self.fname, delimiter='::')
+        row = views.next()
+        self.assertEqual((row[0], row[1], row[2]), ('ab', 'cd', 'ef'))
+        self.assertRaises(IndexError, row.__getitem__, 3)
+        views.close()
+        self.assertEqual(iters.tsv_2_view_iterator(self.fname, delimiter='::', columns=[2, 1]).next(), ('ef', 'cd'))
+
+    def test_typed_tsv_iterator_1(self):
+        """
+        The values are converted, the empty fields get the defaults, and bad values are skipped.
+        """
+        with open(self.fname, 'a') as fout:
+            fout.write('7\t\tx\n8\tnot a number\ty\n\t3.0\tz\r\n9\t2.5\t\n')
+
+        schema = iters.TsvSchema([('a', int, 0), ('b', float, -1.0), ('c', None, '')])
+        records = list(iters.typed_tsv_iterator(self.fname, schema, has_header=True))
+
+        self.assertEqual(len(records), 1003)
+        self.assertEqual(records[3], (3, 6.0, '9'))
+        self.assertEqual(records[3].b, 6.0)
+        # empty first and last columns get the defaults too.
+        self.assertEqual(records[-3:], [(7, -1.0, 'x'), (0, 3.0, 'z'), (9, 2.5, '')])
+
+        schema = iters.TsvSchema([('a', int, 0), ('b', float, -1.0), ('c', None, '', 'S8')])
+        arrays = list(iters.typed_tsv_2_structured_arrays(self.fname, schema, batch_size=600, has_header=True))
+        self.assertEqual([len(arr) for arr in arrays], [600, 403])
+        self.assertEqual(arrays[1]['a'].sum(), sum(xrange(600, 1000)) + 7 + 9)
+        self.assertEqual(arrays[0]['c'][2], '6')
+
+    def test_tsv_filter_1(self):
+        """
+        The projected and parallel filters write the same lines as the plain one.
+        """
+        outputs = [os.path.join(self.tmp_dir, 'out%d.tsv' % i) for i in xrange(4)]
+
+        iters.tsv_filter(self.fname, outputs[0], ['a', 'b', 'c'], _b_is_even, has_header=True)
+        iters.tsv_filter(self.fname, outputs[1], ['a', 'b', 'c'], _b_is_even, has_header=True, keep_columns=['b'])
+        iters.tsv_filter(self.fname, outputs[2], ['a', 'b', 'c'], _b_is_even, has_header=True, keep_columns=['b'],
+                         processes=3, chunk_bytes=500)
+        iters.tsv_filter(self.fname, outputs[3], ['a', 'b', 'c'], _b_is_even, has_header=True, keep_columns=['b'],
+                         output_columns=['c', 'a'], processes=2)
+
+        contents = [open(output).read() for output in outputs]
+        self.assertEqual(contents[0].count('\n'), 501)
+        self.assertEqual(contents[1], contents[0])
+        self.assertEqual(contents[2], contents[0])
+        self.assertEqual(contents[3].split('\n')[:3], ['c\ta', '0\t0', '6\t2'])
+
+        # compressed outputs of the parallel filter read back whole.
+        for extension in ('.gz', '.bz2'):
+            compressed = os.path.join(self.tmp_dir, 'out.tsv' + extension)
+            iters.tsv_filter(self.fname, compressed, ['a', 'b', 'c'], _b_is_even, has_header=True, processes=3,
+                             chunk_bytes=500)
+            with fileio.open_file(compressed) as fin:
+                self.assertEqual(''.join(fin), contents[0])
+
+        projected = iters.tsv_2_dict_iterator(self.fname, names=['a', 'b', 'c'], columns=['b'], processes=2)
+        self.assertEqual([row['b'] for row in projected], [str(i * 2) for i in xrange(1000)])
+        self.assertEqual(iters.tsv_2_dict_iterator(self.fname, use_header_as_schema=True, columns=['c', 'a']).next(),
+                         {'a': '0', 'c': '0'})
+
+    def test_json_batch_iterator_1(self):
+        """
+        Projection of nested fields, converters and the count of malformed lines.
+        """
+        fname = os.path.join(self.tmp_dir, 'events.json')
+        with open(fname, 'w') as fout:
+            for i in xrange(100):
+                fout.write('{"id": %d, "user": {"name": "u%d", "tags": [%d]}}\n' % (i, i % 3, i * 2))
+            fout.write('{"id": \n\n{"id": "x"}\n')
+
+        self.assertEqual(list(iters.json_file_batch_iterator(fname, batch_lines=7))[:100],
+                         list(islice(iters.json_file_iterator(fname), 100)))
+
+        errors = {}
+        rows = list(iters.json_file_batch_iterator(fname, fields=['id', 'user.name', ('user', 'tags', 0), 'none'],
+                                                   converters=[int, None, float, None], processes=2, batch_lines=7,
+                                                   errors=errors))
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(rows[4], (4, 'u1', 8.0, None))
+        self.assertEqual(errors, {'malformed': 2})
+
+        columns = iters.json_file_2_columns(fname, ['id', 'user.tags.0'], [np.int64, np.float32], converters=[int, int])
+        self.assertEqual(columns['id'].sum(), sum(xrange(100)))
+        self.assertEqual(columns['user.tags.0'].dtype, np.float32)
+
+
+class TestCompressedFiles(unittest.TestCase):
+    """
+    Test cases for reading and writing compressed files.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip_1(self):
+        """
+        Write gzip and bz2 files by their extensions, and read them back (also without the extension).
+        """
+        rows = [{'a': str(i), 'b': str(i * i)} for i in xrange(5000)]
+
+        for extension, magic in (('.gz', '\x1f\x8b'), ('.bz2', 'BZh')):
+            fname = os.path.join(self.tmp_dir, 'data.tsv' + extension)
+            iters.iter_2_tsv(iter(rows), fname, ['a', 'b'], has_header=True)
+
+            with open(fname, 'rb') as fin:
+                self.assertEqual(fin.read(len(magic)), magic)
+
+            renamed = os.path.join(self.tmp_dir, 'data')
+            os.rename(fname, renamed)
+            self.assertEqual(list(iters.tsv_2_dict_iterator(renamed, use_header_as_schema=True, processes=2)), rows)
+            self.assertEqual(iters.get_schema(renamed), ['a', 'b'])
+
+    def test_compressed_shards_1(self):
+        """
+        gzip shards, with reopened (appended) files.
+        """
+        prefix = os.path.join(self.tmp_dir, 'shard')
+        records = [{'k': i % 37, 'v': i} for i in xrange(500)]
+        iters.iter_2_tsv_shards(iter(records), prefix, ['k', 'v'], 'k', splits=7, buffer_bytes=20, max_open=2,
+                                compresslevel=1)
+
+        with open(prefix + '0', 'rb') as fin:
+            self.assertEqual(fin.read(2), '\x1f\x8b')
+
+        rows = iters.tsv_shards_2_dict_flattened(prefix, ['k', 'v'], splits=7)
+        self.assertEqual(sorted(int(row['v']) for row in rows), range(500))
+
+
+class TestSortGroupBy(unittest.TestCase):
+    """
+    Test cases for the external sort and the group by.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_external_sort_1(self):
+        """
+        Same as sorted(), stable, with several runs.
+        """
+        items = [(i * 7919 % 101, i) for i in xrange(1000)]
+        key = lambda item: item[0]
+
+        self.assertEqual(list(iters.external_sort(iter(items), key=key, max_items_in_memory=64)), sorted(items, key=key))
+        self.assertEqual(list(iters.external_sort(items, max_items_in_memory=5000)), sorted(items))
+
+    def test_tsv_groupby_1(self):
+        """
+        Group a tsv file on an integer column.
+        """
+        fname = os.path.join(self.tmp_dir, 'data.tsv')
+        iters.tuple_iter_2_tsv(((i % 12, i) for i in xrange(120)), fname)
+
+        groups = [(key, [int(row['v']) for row in rows])
+                  for key, rows in iters.tsv_groupby(fname, ['k', 'v'], 'k', key_types={'k': int}, max_rows_in_memory=10)]
+
+        self.assertEqual([key for key, _ in groups], range(12))
+        self.assertEqual(groups[5][1], range(5, 120, 12))
+
+        output = os.path.join(self.tmp_dir, 'sorted.tsv')
+        iters.tsv_sort(fname, output, ['k', 'v'], ['k', 'v'], key_types={'k': int, 'v': int}, max_rows_in_memory=7)
+        self.assertEqual(list(iters.tsv_2_tuple_iterator(output, 2))[:2], [['0', '0'], ['0', '12']])
+
+    def test_tsv_shards_groupby_1(self):
+        """
+        Group by over shards.
+        """
+        prefix = os.path.join(self.tmp_dir, 'shard')
+        iters.iter_2_tsv_shards(({'k': i % 9, 'v': i} for i in xrange(90)), prefix, ['k', 'v'], 'k', splits=4)
+
+        groups = dict((key, len(list(rows))) for key, rows in iters.tsv_shards_groupby(prefix, ['k', 'v'], 'k', splits=4))
+        self.assertEqual(groups, dict((str(i), 10) for i in xrange(9)))
+
+
+class TestShards(unittest.TestCase):
+    """
+    Test cases for the shard writers.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_shard_writer_1(self):
+        """
+        All the records are kept and each key goes to stable_hash(key) % splits, with few open files and tiny buffers.
+        """
+        prefix = os.path.join(self.tmp_dir, 'shard')
+        records = [{'k': i % 37, 'v': i} for i in xrange(500)]
+        iters.iter_2_tsv_shards(iter(records), prefix, ['k', 'v'], 'k', splits=7, buffer_bytes=20, max_open=2)
+
+        rows = list(iters.tsv_shards_2_dict_flattened(prefix, ['k', 'v'], splits=7))
+        self.assertEqual(sorted(int(row['v']) for row in rows), range(500))
+
+        for split, shard in enumerate(iters.tsv_shards_2_dict(prefix, ['k', 'v'], splits=7)):
+            for row in shard:
+                self.assertEqual(iters.stable_hash(int(row['k'])) % 7, split)
+
+    def test_shard_writer_unicode_1(self):
+        """
+        Non ascii unicode keys (as from json_file_iterator) go to the same shard as their utf-8 strings.
+        """
+        prefix = os.path.join(self.tmp_dir, 'shard')
+        records = [{'k': u'caf\xe9', 'v': 1}, {'k': u'na\xefve', 'v': 2}]
+        iters.iter_2_tsv_shards(iter(records), prefix, ['k', 'v'], 'k', splits=7)
+
+        for split, shard in enumerate(iters.tsv_shards_2_dict(prefix, ['k', 'v'], splits=7)):
+            for row in shard:
+                self.assertEqual(iters.stable_hash(row['k'].decode('utf-8')) % 7, split)
+                self.assertEqual(iters.stable_hash(row['k']) % 7, split)
+
+    def test_map_reduce_shards_1(self):
+        """
+        Counting the keys over all the shards.
+        """
+        prefix = os.path.join(self.tmp_dir, 'shard')
+        iters.iter_2_tsv_shards(({'k': i % 13, 'v': i} for i in xrange(130)), prefix, ['k', 'v'], 'k', splits=5)
+
+        counts = iters.map_reduce_shards(prefix, _count_keys, tools.sum_2_dictionaries, splits=5, processes=2)
+        self.assertEqual(counts, dict((str(i), 10) for i in xrange(13)))
+
+    def test_files_2_shards_1(self):
+        """
+        Sharding files in parallel puts the lines into the same shards as the iterator version.
+        """
+        filenames = []
+        for i in xrange(3):
+            filenames.append(os.path.join(self.tmp_dir, 'input%d' % i))
+            with open(filenames[-1], 'w') as fout:
+                for j in xrange(100):
+                    fout.write('%d\tkey%d\n' % (j, (i * j) % 11))
+
+        iters.tsv_files_2_shards(filenames, os.path.join(self.tmp_dir, 'a'), 1, splits=5, processes=2)
+
+        rows = chain.from_iterable(iters.tsv_2_tuple_iterator(filename, 2) for filename in filenames)
+        iters.tuple_iter_2_tsv_shards(rows, os.path.join(self.tmp_dir, 'b'), 1, splits=5)
+
+        for split in xrange(5):
+            with open(os.path.join(self.tmp_dir, 'a%d' % split)) as fin_a, \
+                    open(os.path.join(self.tmp_dir, 'b%d' % split)) as fin_b:
+                self.assertEqual(sorted(fin_a), sorted(fin_b))
+
+        # the part shards are cleaned up.
+        expected_files = ['input%d' % i for i in xrange(3)] + ['a%d' % i for i in xrange(5)] + ['b%d' % i for i in xrange(5)]
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), sorted(expected_files))
+
+    def test_tsv_join_1(self):
+        """
+        inner and left joins, serial and parallel, with either side being the smaller one.
+        """
+        left = os.path.join(self.tmp_dir, 'left.tsv')
+        right = os.path.join(self.tmp_dir, 'right.tsv')
+        iters.tuple_iter_2_tsv(((i, 'l%d' % i) for i in xrange(20)), left)
+        iters.tuple_iter_2_tsv(((i % 10, 'r%d' % i) for i in xrange(0, 40, 3)), right)
+
+        def expected(how):
+            rights = [(str(i % 10), 'r%d' % i) for i in xrange(0, 40, 3)]
+            rows = []
+            for i in xrange(20):
+                matches = [r for k, r in rights if k == str(i)]
+                if not matches and how == 'left':
+                    matches = [None]
+                rows.extend((str(i), 'l%d' % i, r) for r in matches)
+            return sorted(rows)
+
+        for how in ('inner', 'left'):
+            for processes in (None, 2):
+                for (first, first_names), (second, second_names) in (((left, ['k', 'l']), (right, ['k', 'r'])),
+                                                                     ((right, ['k', 'r']), (left, ['k', 'l']))):
+                    if first == right and how == 'left':
+                        continue
+                    joined = iters.tsv_join(first, second, first_names, second_names, 'k', how=how, splits=3,
+                                            processes=processes, tmp_dir=self.tmp_dir)
+                    self.assertEqual(sorted((row['k'], row['l'], row['r']) for row in joined), expected(how))
+
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['left.tsv', 'right.tsv'])
+
+        # the same non key column on both sides, or a bad how, fail at the call, not at the first row.
+        self.assertRaises(ValueError, iters.tsv_join, left, right, ['k', 'v'], ['k', 'v'], 'k', tmp_dir=self.tmp_dir)
+        self.assertRaises(ValueError, iters.join_shards, 'left', 'right', ['k', 'l'], ['k', 'r'], 'k', how='outer')
+
+
+if __name__ == "__main__":
+    unittest.main()
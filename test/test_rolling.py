@@ -0,0 +1,48 @@
+import unittest
+
+import numpy as np
+
+from fengpy import rolling, tools
+
+
+class TestRolling(unittest.TestCase):
+    """
+    Test cases for the rolling aggregates, against the aggregates of every window.
+    """
+    def test_aggregates_1(self):
+        arr = np.random.RandomState(0).randn(103) * 10 + 1000
+        for n in (1, 2, 7, 10, 103):
+            windows = rolling.rolling_window(arr, n)
+
+            np.testing.assert_allclose(rolling.rolling_sum(arr, n), windows.sum(axis=1))
+            np.testing.assert_allclose(rolling.rolling_mean(arr, n), windows.mean(axis=1))
+            np.testing.assert_allclose(rolling.rolling_std(arr, n, ddof=0), windows.std(axis=1), atol=1e-8)
+            np.testing.assert_array_equal(rolling.rolling_max(arr, n), windows.max(axis=1))
+            np.testing.assert_array_equal(rolling.rolling_min(arr, n), windows.min(axis=1))
+
+        self.assertRaises(ValueError, rolling.rolling_sum, arr, 104)
+
+    def test_std_precision_1(self):
+        """
+        The std keeps its precision on big offsets and trends, checked against np.std of the windows one by one.
+        """
+        noise = np.random.RandomState(0).randn(100000)
+        for arr in (1e9 + noise, np.arange(100000.) * 10 + noise, np.where(np.arange(100000) % 1000 < 500, 0, 1e9) + noise):
+            for n, ddof in ((20, 1), (999, 0)):
+                observed = rolling.rolling_std(arr, n, ddof=ddof)
+                for i in xrange(0, len(observed), 997):
+                    self.assertAlmostEqual(observed[i] / np.std(arr[i: i + n], ddof=ddof), 1.0, places=6)
+
+    def test_window_1(self):
+        """
+        The views and the generic window agree.
+        """
+        arr = np.arange(10)
+        self.assertEqual([tuple(row) for row in rolling.rolling_window(arr, 3)], list(tools.window(range(10), 3)))
+        self.assertFalse(rolling.rolling_window(arr, 3).flags.writeable)
+        self.assertEqual(rolling.rolling_sum(arr, 4).dtype, np.int64)
+        self.assertEqual(list(tools.window(range(2), 3)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
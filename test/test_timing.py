@@ -0,0 +1,79 @@
+from multiprocessing import Pool
+import unittest
+
+from fengpy import timing
+
+
+def square(x):
+    with timing.span('square'):
+        return x * x
+
+
+def is_enabled(_):
+    return timing.is_enabled()
+
+
+class TestTiming(unittest.TestCase):
+    """
+    Test cases for the timing spans and counters.
+    """
+    def tearDown(self):
+        timing.disable()
+        timing.reset()
+
+    def test_disabled_1(self):
+        """
+        Nothing is recorded, and the iterables are passed through.
+        """
+        rows = iter(range(3))
+        self.assertTrue(timing.count_rows(rows) is rows)
+        self.assertTrue(timing.span('a') is timing.span('b'))
+        with timing.span('a'):
+            pass
+
+        self.assertEqual(timing.snapshot(), {})
+
+    def test_spans_1(self):
+        @timing.timed()
+        def parse(rows):
+            with timing.span('split'):
+                return [row.split() for row in rows]
+
+        timing.enable()
+        with timing.span('load'):
+            for _ in xrange(2):
+                parse(timing.count_rows(['a b'] * 5))
+
+        stats = timing.snapshot()
+        self.assertEqual(sorted(stats), ['load', 'load/parse', 'load/parse/split', 'load/rows'])
+        self.assertEqual(stats['load/parse'][0], 2)
+        self.assertEqual(stats['load/rows'][2], 10)
+        self.assertTrue(stats['load'][1] >= stats['load/parse'][1])
+
+        report = timing.report()
+        self.assertTrue('    split' in report)
+
+    def test_map_with_stats_1(self):
+        """
+        The stats of the workers are merged into the parent.
+        """
+        pool = Pool(2)
+        try:
+            timing.enable()
+            self.assertEqual(timing.map_with_stats(pool, square, range(6)), [x * x for x in range(6)])
+
+            # the workers are not left enabled for the next tasks.
+            timing.disable()
+            self.assertEqual(pool.map(is_enabled, range(6)), [False] * 6)
+            timing.enable()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        self.assertEqual(timing.snapshot()['square'][0], 6)
+        timing.merge({'square': (1, 0.5, 0)})
+        self.assertEqual(timing.snapshot()['square'][0], 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+from itertools import islice
+import os
+import unittest
+
+import numpy as np
+
+from fengpy import tools
+
+
+class TestSumDictionaries(unittest.TestCase):
+    """
+    Test cases for the k-way dictionary sums.
+    """
+    def test_sum_dictionaries_1(self):
+        """
+        Same as folding with sum_2_dictionaries, and the accumulator is updated in place.
+        """
+        dicts = [{'a': 10, 'b': 1}, {'b': 3, 'c': 2}, {'c': 1, 'd': 4}]
+        acc = {'a': 1}
+
+        self.assertEqual(tools.sum_dictionaries(dicts), reduce(tools.sum_2_dictionaries, dicts))
+        self.assertTrue(tools.sum_dictionaries(dicts, acc) is acc)
+        self.assertEqual(acc, {'a': 11, 'b': 4, 'c': 3, 'd': 4})
+
+    def test_sum_2level_dicts_generic_1(self):
+        """
+        Same as folding with sum_2_2level_dicts_generic, and the input values are not changed.
+        """
+        d1 = {'u1': {'a': [1, 2], 'b': [3, 0], 'd': [0, 4]}, 'u2': {'b': [3, 3], 'c': [2, 1]}}
+        d2 = {'u1': {'a': [1, 2], 'd': [0, 4]}, 'u2': {'b': [3, 3], 'c': [2, 1]}, 'u3': {'a': [3, 2], 'f': [1, 0]}}
+
+        def defaultfunc():
+            return [0, 0]
+
+        def addfunc(x, y):
+            return [x[0] + y[0], x[1] + y[1]]
+
+        def addfunc_in_place(x, y):
+            x[0] += y[0]
+            x[1] += y[1]
+            return x
+
+        expected = reduce(lambda x, y: tools.sum_2_2level_dicts_generic(x, y, defaultfunc, addfunc), [d1, d2, d1])
+        self.assertEqual(tools.sum_2level_dicts_generic([d1, d2, d1], defaultfunc, addfunc_in_place), expected)
+        self.assertEqual(d1['u1']['a'], [1, 2])
+        self.assertEqual(tools.sum_2level_dicts([{'u': {'a': 1}}, {'u': {'a': 2}, 'v': {'b': 1}}]),
+                         {'u': {'a': 3}, 'v': {'b': 1}})
+
+    def test_sum_dictionaries_dense_1(self):
+        """
+        The numpy version for integer keys.
+        """
+        counts = tools.sum_dictionaries_dense([{0: 1, 3: 2}, {}, {3: 5, 9: 1}])
+        np.testing.assert_array_equal(counts, [1, 0, 0, 7, 0, 0, 0, 0, 0, 1])
+
+        self.assertEqual(len(tools.sum_dictionaries_dense([{1: 1}], size=5)), 5)
+        self.assertRaises(ValueError, tools.sum_dictionaries_dense, [{1: 1}, {-1: 2}])
+
+
+class TestChunking(unittest.TestCase):
+    """
+    Test cases for array_chunker and prefetch.
+    """
+    def test_array_chunker_1(self):
+        rows = [(i, i * 2.0) for i in xrange(7)]
+
+        chunks = [chunk.copy() for chunk in tools.array_chunker(3, rows)]
+        self.assertEqual([chunk.shape for chunk in chunks], [(3, 2), (3, 2), (1, 2)])
+        np.testing.assert_array_equal(np.concatenate(chunks), rows)
+
+        columns = list(tools.array_chunker(3, rows, columns=True, reuse=False))
+        np.testing.assert_array_equal(columns[-1], [[6], [12]])
+        self.assertTrue(columns[0][0].flags.c_contiguous)
+
+        np.testing.assert_array_equal(list(tools.array_chunker(5, xrange(5), dtype=np.int32))[0], range(5))
+
+    def test_prefetch_1(self):
+        """
+        Same items in the same order, with a thread or a process, and the errors of the upstream are raised.
+        """
+        def numbers(fail_at=None):
+            for i in xrange(1000):
+                if i == fail_at:
+                    raise KeyError(i)
+                yield i
+
+        self.assertEqual(list(tools.prefetch(numbers(), buffer_size=2, chunk_size=7)), range(1000))
+        self.assertEqual(list(tools.prefetch(numbers(), chunk_size=7, use_process=True)), range(1000))
+        self.assertEqual(list(islice(tools.prefetch(numbers(), buffer_size=1, chunk_size=1), 5)), range(5))
+
+        for use_process in (False, True):
+            self.assertRaises(KeyError, list, tools.prefetch(numbers(fail_at=500), use_process=use_process))
+
+        def dying():
+            yield 1
+            os._exit(3)
+
+        # the process is gone without a word, no waiting forever.
+        self.assertRaises(RuntimeError, list, tools.prefetch(dying(), chunk_size=1, use_process=True))
+
+
+class TestKFold(unittest.TestCase):
+    """
+    Test cases for k_fold_indices.
+    """
+    def check_folds(self, folds, data_size):
+        testing = np.concatenate([test for _, test in folds])
+        self.assertEqual(sorted(testing), range(data_size))
+        for train, test in folds:
+            self.assertEqual(sorted(np.concatenate((train, test))), range(data_size))
+
+    def test_k_fold_indices_1(self):
+        folds = list(tools.k_fold_indices(23, 5, seed=3))
+        self.check_folds(folds, 23)
+        self.assertEqual([len(test) for _, test in folds], [4, 5, 4, 5, 5])
+
+        # the same seed, the same folds.
+        for (train, test), (train2, test2) in zip(folds, tools.k_fold_indices(23, 5, seed=3)):
+            np.testing.assert_array_equal(train, train2)
+            np.testing.assert_array_equal(test, test2)
+
+    def test_k_fold_indices_2(self):
+        """
+        Stratified and grouped folds.
+        """
+        labels = np.array([0] * 30 + [1] * 10)
+        folds = list(tools.k_fold_indices(40, 5, seed=0, labels=labels))
+        self.check_folds(folds, 40)
+        self.assertEqual([labels[test].sum() for _, test in folds], [2] * 5)
+
+        column_folds = list(tools.k_fold_indices(40, 5, seed=0, labels=labels.reshape(-1, 1)))
+        for (_, test), (_, column_test) in zip(folds, column_folds):
+            np.testing.assert_array_equal(test, column_test)
+        self.assertRaises(ValueError, list, tools.k_fold_indices(40, 5, labels=np.zeros((40, 2))))
+
+        groups = np.arange(40) // 4
+        folds = list(tools.k_fold_indices(40, 5, seed=0, groups=groups))
+        self.check_folds(folds, 40)
+        for train, test in folds:
+            self.assertFalse(set(groups[train]) & set(groups[test]))
+
+        self.assertRaises(ValueError, list, tools.k_fold_indices(40, 20, groups=groups))
+
+
+if __name__ == "__main__":
+    unittest.main()
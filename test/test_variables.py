@@ -1,7 +1,29 @@
+import copy
+import functools
+import os
+import shutil
+import tempfile
 import unittest
+
+import numpy as np
+
 from fengpy import variables
 
 
+class SumModel(object):
+    """
+    A tiny model used in the tests. It predicts the sum of the (normalized) predictors.
+    """
+    def fit(self, X, y):
+        self.offset = np.mean(y) - np.mean(np.sum(X, axis=1))
+
+    def predict(self, X):
+        return np.sum(X, axis=1) + self.offset
+
+    def partial_fit(self, X, y):
+        self.seen = getattr(self, 'seen', 0) + len(y)
+
+
 class TestVariable(unittest.TestCase):
     """
     Test cases for dumps_variable_def.
@@ -105,6 +127,275 @@ class TestModelVariables(unittest.TestCase):
         self.assertTrue(var3.normalization)
         self.assertEqual(var3.mean_std, [2.0, 0.3])
 
+    def test_get_training_data_columnar_1(self):
+        """
+        Test the columnar loading gives the same X, y as the default one.
+        """
+        var1 = variables.Variable(name='test1', transform=lambda x: float(x[0]))
+        var2 = variables.Variable(name='test2', transform=lambda x: float(x[1]) * 2)
+        var3 = variables.Variable(name='test3', transform=lambda x: float(x[2]))
+
+        model_vars = variables.ModelVariables(independent=[var2, var3], dependent=[var1], schema=[var1, var2, var3])
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmp_dir, 'training.tsv')
+            with open(fname, 'w') as fout:
+                fout.write('test1\ttest2\ttest3\n')
+                for i in xrange(25):
+                    fout.write('%d\t%d\t%d\n' % (i, i + 1, i * i))
+
+            X, y = model_vars.get_training_data(fname)
+            X_col, y_col = model_vars.get_training_data(fname, columnar=True, dtype=np.float32, batch_size=4)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual(X_col.dtype, np.float32)
+        self.assertEqual(X_col.shape, (25, 2))
+        np.testing.assert_array_equal(X, X_col)
+        np.testing.assert_array_equal(y, y_col)
+
+    def test_training_data_cache_1(self):
+        """
+        The second read comes from the cache, a change of the transforms misses it, and the size cap holds.
+        """
+        def model_vars(factor):
+            var1 = variables.Variable(name='test1', transform=lambda x: float(x[0]))
+            var2 = variables.Variable(name='test2', transform=lambda x: float(x[1]) * factor)
+            return variables.ModelVariables(independent=[var2], dependent=[var1], schema=[var1, var2])
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmp_dir, 'training.tsv')
+            with open(fname, 'w') as fout:
+                for i in xrange(100):
+                    fout.write('%d\t%d\n' % (i, i + 1))
+
+            cache = variables.TrainingDataCache(os.path.join(tmp_dir, 'cache'))
+            X, y = model_vars(2).get_training_data(fname, header=False, cache=cache)
+            X_cached, y_cached = model_vars(2).get_training_data(fname, header=False, cache=cache)
+
+            self.assertTrue(isinstance(X_cached, np.memmap))
+            np.testing.assert_array_equal(X, X_cached)
+            np.testing.assert_array_equal(y, y_cached)
+
+            X_other, _ = model_vars(3).get_training_data(fname, header=False, cache=cache)
+            self.assertFalse(isinstance(X_other, np.memmap))
+            self.assertEqual(len(os.listdir(cache.cache_dir)), 4)
+
+            cache.max_bytes = 3000
+            cache.evict()
+            self.assertEqual(len(os.listdir(cache.cache_dir)), 2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_training_data_cache_key_1(self):
+        """
+        The key does not depend on the addresses of the functions, but follows the code of the helpers they call,
+        and is None for the values that can not be fingerprinted.
+        """
+        def make_helper(offset):
+            # a new function object every time.
+            def helper(x):
+                return float(x) + offset
+            return helper
+
+        def model_vars(helper, scale=None):
+            transform = functools.partial(lambda h, x: h(x[1]), helper)
+            var1 = variables.Variable(name='test1', transform=lambda x: helper(x[0]))
+            var2 = variables.Variable(name='test2', transform=transform if scale is None else lambda x: scale)
+            return variables.ModelVariables(independent=[var2], dependent=[var1], schema=[var1, var2])
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmp_dir, 'training.tsv')
+            with open(fname, 'w') as fout:
+                fout.write('1\t2\n')
+
+            cache = variables.TrainingDataCache(os.path.join(tmp_dir, 'cache'))
+            key = cache.key(model_vars(make_helper(1)), fname)
+            self.assertEqual(cache.key(model_vars(make_helper(1)), fname), key)
+            self.assertNotEqual(cache.key(model_vars(make_helper(2)), fname), key)
+            self.assertNotEqual(cache.key(model_vars(lambda x: float(x) * 2), fname), key)
+
+            unknown = model_vars(make_helper(1), scale=object())
+            self.assertEqual(cache.key(unknown, fname), None)
+            unknown.get_training_data(fname, header=False, cache=cache)
+            self.assertEqual(os.listdir(cache.cache_dir), [])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_write_training_data_shared_step_1(self):
+        """
+        write_training_data with a shared step that is only computed once per item.
+        """
+        calls = []
+
+        def parse(x):
+            calls.append(x)
+            return x.split(':')
+
+        parsed = variables.SharedStep(parse)
+        var1 = variables.Variable(name='a', pre_transform=lambda x: parsed(x)[0])
+        var2 = variables.Variable(name='b', pre_transform=lambda x: int(parsed(x)[1]) * 2)
+
+        model_vars = variables.ModelVariables(independent=[var2], dependent=[var1], schema=[var1, var2])
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmp_dir, 'training.tsv')
+            model_vars.write_training_data(['x:1', 'y:2', 'z:3'], fname, header=True)
+            with open(fname) as fin:
+                self.assertEqual(fin.read(), 'a\tb\nx\t2\ny\t4\nz\t6\n')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(model_vars.data_str('z:5'), 'z\t10')
+
+
+class TestModelDriver(unittest.TestCase):
+    """
+    Test cases for ModelDriver.
+    """
+    def setUp(self):
+        var1 = variables.Variable(name='y', transform=lambda x: x[0])
+        var2 = variables.Variable(name='a', post_transform=lambda x: x['a'], normalization=True)
+        var3 = variables.Variable(name='b', post_transform=lambda x: x['b'] * 2, normalization=False)
+        self.model_vars = variables.ModelVariables(independent=[var2, var3], dependent=[var1], schema=[var1, var2, var3])
+
+        self.X = np.array([[1., 2.], [3., 0.], [5., 1.], [7., 3.]])
+        self.y = np.array([1., 2., 3., 4.])
+
+    def test_normalize_1(self):
+        """
+        Only the normalized columns are changed, the predictors are not touched by fit, and float32 works.
+        """
+        X = self.X.copy()
+        driver = variables.ModelDriver(self.model_vars, SumModel(), dtype=np.float32)
+        driver.fit(X, self.y, reuse_buffer=True)
+
+        np.testing.assert_array_equal(X, self.X)
+        self.assertEqual(self.model_vars.independent[0].mean_std, [4.0, np.sqrt(5.0)])
+        self.assertEqual(driver._fit_buffer.dtype, np.float32)
+
+        normalized = driver.normalize(self.X, calculate_mean_std=False, out=np.empty(self.X.shape))
+        np.testing.assert_allclose(normalized[:, 0], (self.X[:, 0] - 4.0) / np.sqrt(5.0))
+        np.testing.assert_array_equal(normalized[:, 1], self.X[:, 1])
+
+        # a smaller data set reuses the buffer.
+        buf = driver._fit_buffer
+        driver.fit(X[:3], self.y[:3], reuse_buffer=True)
+        self.assertTrue(driver._fit_buffer is buf)
+
+        # the buffer is not kept by default, and the normalization is compiled again after a fit.
+        compiled = driver.compile_normalization()
+        self.assertTrue(driver.compile_normalization() is compiled)
+        driver.fit(X[:2], self.y[:2])
+        self.assertTrue(driver._fit_buffer is None)
+        self.assertEqual(driver.compile_normalization()[1][0], 2.0)
+
+    def test_fit_from_tsv_1(self):
+        """
+        The out of core training gets the same normalization parameters as the in memory one.
+        """
+        var1 = variables.Variable(name='y', transform=lambda x: float(x[0]))
+        var2 = variables.Variable(name='a', transform=lambda x: float(x[1]), normalization=True)
+        var3 = variables.Variable(name='b', transform=lambda x: float(x[2]), normalization=True)
+
+        def driver():
+            model_vars = variables.ModelVariables(independent=[var2, var3], dependent=[var1], schema=[])
+            return variables.ModelDriver(copy.deepcopy(model_vars), SumModel())
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmp_dir, 'training.tsv')
+            with open(fname, 'w') as fout:
+                for i in xrange(103):
+                    fout.write('%d\t%f\t%f\n' % (i, 1e6 + i * 0.5, (i % 7) ** 2))
+
+            in_memory = driver()
+            in_memory.fit(*in_memory.variable_def.get_training_data(fname, header=False))
+
+            streaming = driver()
+            streaming.fit_from_tsv(fname, header=False, chunk_size=10)
+
+            prefetched = driver()
+            prefetched.fit_from_tsv(fname, header=False, chunk_size=10, prefetch_chunks=2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual(streaming.model.seen, 103)
+        self.assertEqual(prefetched.model.seen, 103)
+        for expected, observed in zip(in_memory.variable_def.independent, streaming.variable_def.independent):
+            np.testing.assert_allclose(observed.mean_std, expected.mean_std, rtol=1e-10)
+
+    def test_model_file_1(self):
+        """
+        A model saved by save_model_file loads back with its arrays and normalization parameters.
+        """
+        driver = variables.ModelDriver(self.model_vars, SumModel())
+        driver.fit(self.X, self.y)
+        driver.model.weights = np.arange(1000.).reshape(100, 10).T
+        driver.model.same_weights = driver.model.weights
+
+        new_vars = copy.deepcopy(self.model_vars)
+        new_vars.independent[0].mean_std = None
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmp_dir, 'model.bin')
+            driver.save_model_file(fname)
+            # the shared array is written once.
+            self.assertTrue(os.path.getsize(fname) < 2 * driver.model.weights.nbytes)
+
+            for use_mmap in (True, False):
+                loaded = variables.ModelDriver(new_vars)
+                loaded.load_model_file(fname, use_mmap=use_mmap)
+
+                self.assertEqual(new_vars.independent[0].mean_std, self.model_vars.independent[0].mean_std)
+                np.testing.assert_array_equal(loaded.model.weights, driver.model.weights)
+                self.assertTrue(loaded.model.same_weights is loaded.model.weights)
+                np.testing.assert_allclose(loaded.predict(self.X), driver.predict(self.X))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_predict_items_1(self):
+        """
+        predict_items gives the same predictions as item_predict one by one.
+        """
+        driver = variables.ModelDriver(self.model_vars, SumModel())
+        driver.fit(self.X, self.y)
+
+        items = [{'a': float(i), 'b': i % 3 + 0.5} for i in xrange(10)]
+        expected = np.concatenate([driver.item_predict(item) for item in items])
+
+        np.testing.assert_allclose(driver.predict_items(items), expected)
+        np.testing.assert_allclose(driver.predict_items(iter(items), batch_size=3), expected)
+
+    def test_k_fold_parallel_1(self):
+        """
+        The parallel k-fold gives the same average as the serial one for a fixed seed.
+        """
+        X = np.random.RandomState(0).rand(50, 2)
+        y = np.arange(50.)
+
+        def mean_abs_error(observed, predicted):
+            return np.mean(np.abs(observed - predicted))
+
+        results = []
+        for n_jobs in (None, 3):
+            results.append(variables.k_fold_train_test_model(SumModel(), X, y, mean_abs_error, self.model_vars,
+                                                             k_fold=5, n_jobs=n_jobs, seed=1))
+            results.append(variables.k_fold_train_test_simple_model(SumModel(), X, y, mean_abs_error,
+                                                                    k_fold=5, n_jobs=n_jobs, seed=1))
+
+        self.assertEqual(results[0], results[2])
+        self.assertEqual(results[1], results[3])
+
+        self.assertRaises(ValueError, variables.k_fold_train_test_simple_model, SumModel(), X, y, mean_abs_error,
+                          n_jobs=0)
+
 
 if __name__ == "__main__":
     unittest.main()